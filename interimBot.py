@@ -14,31 +14,48 @@
 import os
 import sys
 from re import compile as reCompile
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError, RetryAfter, TimedOut, NetworkError, BadRequest
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler
-from telegram.ext import ConversationHandler, MessageHandler, Filters, MessageFilter
+from telegram.ext import ConversationHandler, MessageHandler, Filters, MessageFilter, BasePersistence
+from telegram.ext import Dispatcher, JobQueue, TypeHandler
+from telegram.utils.request import Request
 import sqlite3
+import threading
+import queue
+import multiprocessing
+from signal import signal, SIGINT, SIGTERM, SIG_IGN
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from collections import defaultdict, deque
+from cachetools import TTLCache
+import json
 from datetime import datetime as dt
 from locale import setlocale, LC_ALL
-from openpyxl import Workbook
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+# openpyxl, smtplib et email ne sont chargés qu'à la première utilisation (export excel, envoi des mails)
 from hashlib import md5
+from functools import lru_cache, wraps
+from bisect import bisect_left
+import logging
+from time import time, monotonic, sleep, perf_counter
+from io import BytesIO
 
 # les erreurs critiques
 class Exit(Exception):
 	pass
 
-# mise du programme en français pour les affichage de strftime
-setlocale(LC_ALL, 'fr_FR.utf8')
-
 # dossiers racine du projet
 BASEPATH = os.path.dirname(os.path.realpath(sys.argv[0]))
 # chemin vers la base de donnée
 BDD_PATH = os.path.join(BASEPATH, "data.db")
 # table de la base de donnée
 BDD_TABLE = "missions"
+# le pool de connections à la base de donnée, initialisé au lancement du bot
+POOL_BDD = None
+# la configuration lue dans le .env, initialisée au lancement du bot
+CONFIG = None
 
 # configuration du .env
 REGEX_TOKEN = reCompile("token=[0-9]{8,10}:[a-zA-Z0-9_-]{35}")
@@ -47,46 +64,524 @@ REGEX_SVR_PORT = reCompile("server_port=[0-9]+")
 REGEX_MAIL_FROM = reCompile("mail_from=[a-zA-Z0-9-.@]+")
 REGEX_MAIL_MDP = reCompile("mail_mdp=[a-zA-Z0-9-+/_.:;,|!%$*]+")
 REGEX_MAIL_TO = reCompile("mail_to=[a-zA-Z0-9-.@]+")
+# destinataire optionnel par agence, 'mail_to_{agence}={EMAIL}' (les espaces du nom de l'agence remplacés par '_')
+REGEX_MAIL_AGENCE = reCompile("mail_to_([a-z_]+)=([a-zA-Z0-9-.@]+)")
+# chiffrement STARTTLS de la session smtp (0 pour un serveur local de test), nombre d'essais d'envoi d'un mail
+# et durée en secondes avant fermeture d'une session inutilisée, modifiables avec 'mail_tls=', 'mail_essais=' et 'mail_inactivite='
+REGEX_MAIL_TLS = reCompile("mail_tls=[01]")
+REGEX_MAIL_ESSAIS = reCompile("mail_essais=[0-9]+")
+REGEX_MAIL_INACTIVITE = reCompile("mail_inactivite=[0-9]+")
+MAIL_TLS = 1
+MAIL_ESSAIS = 3
+MAIL_INACTIVITE = 60
+# une session inutilisée depuis plus de MAIL_KEEPALIVE secondes est testée (NOOP) avant d'envoyer
+MAIL_KEEPALIVE = 30
+# nombre maximum de mails envoyés à la suite dans une meme session
+MAIL_LOT = 20
+# le thread d'envoi des mails, initialisé au lancement du bot
+MAILS = None
+REGEX_SQLITE = reCompile("sqlite_(journal_mode|synchronous|cache_size|mmap_size|busy_timeout)=(-?[a-zA-Z0-9]+)")
+REGEX_SQLITE_MAINTENANCE = reCompile("sqlite_maintenance=[0-9]+")
+
+# réglages de sqlite appliqués à l'ouverture de chaque connection, modifiables dans le .env avec 'sqlite_{pragma}={valeur}'
+PRAGMAS_BDD = {
+	"journal_mode": "WAL",
+	"synchronous": "NORMAL",
+	"cache_size": "-8000",
+	"mmap_size": "0",
+	"busy_timeout": "5000",
+}
+# intervalle en secondes entre deux maintenances de la base de donnée, modifiable avec 'sqlite_maintenance={secondes}'
+MAINTENANCE_BDD = 3600
 
 # les demandes pour la création d'un nouvel enregistrement
 AGENCE, DATE, LIEU, H_DEBUT, H_FIN = range(5)
-# le buffer pour enregistrer les infos
-TO_SAVE = []
+# la clef du brouillon de la nouvelle mission dans les données de chaque utilisateur (context.user_data)
+BROUILLON = "nouvelle_mission"
+# nombre de threads du dispatcher traitant les mises à jour en parallèle, modifiable avec 'bot_workers={nombre}'
+REGEX_WORKERS = reCompile("bot_workers=[0-9]+")
+WORKERS = 4
+# nombre d'exports excel simultanés et nombre maximum d'exports en cours ou en attente,
+# modifiables avec 'export_workers={nombre}' et 'export_attente={nombre}'
+REGEX_EXPORT_WORKERS = reCompile("export_workers=[0-9]+")
+REGEX_EXPORT_ATTENTE = reCompile("export_attente=[0-9]+")
+EXPORT_WORKERS = 1
+EXPORT_ATTENTE = 10
+# intervalle minimum en secondes entre deux messages de progression d'un export
+EXPORT_PROGRESSION = 2
+# la file des messages envoyés aux utilisateurs, initialisée au lancement du bot
+# débit par conversation (messages par seconde et rafale) et débit global de telegram, nombre de threads d'envoi
+# et nombre d'essais d'un envoi si telegram ne répond pas
+ENVOIS = None
+ENVOIS_DEBIT_CHAT = 1
+ENVOIS_RAFALE_CHAT = 3
+ENVOIS_DEBIT_GLOBAL = 30
+ENVOIS_WORKERS = 4
+ENVOIS_ESSAIS = 3
+# l'exécuteur des exports excel, initialisé au lancement du bot
+EXPORTS = None
+# mode webhook (à la place du long polling) activé si 'webhook_url={URL publique}' est présent dans le .env
+# le serveur http intégré écoute sur 'webhook_listen:webhook_port' et reçoit les mises à jour sur '/{webhook_path}/{webhook_secret}'
+REGEX_WEBHOOK = reCompile("webhook_(url|listen|port|path|secret)=([a-zA-Z0-9.:/_-]+)")
+WEBHOOK = {
+	"url": "",
+	"listen": "127.0.0.1",
+	"port": "8080",
+	"path": "interimbot",
+	"secret": "",
+}
+# intervalle en secondes entre deux sauvegardes des conversations en cours, modifiable avec 'persistance_intervalle={secondes}'
+REGEX_PERSISTANCE = reCompile("persistance_intervalle=[0-9]+")
+PERSISTANCE_INTERVALLE = 30
+# nombre de missions par page de /affiche_missions et longueur maximum d'une ligne (un message telegram fait au plus 4096 caractères)
+AFFICHAGE_PAGE = 20
+AFFICHAGE_LIGNE = 180
+# nombre de missions par page de /supprime_mission, filtre par mois : 'MM/AAAA' ou 'AAAA-MM'
+SUPPRESSION_PAGE = 10
+REGEX_MOIS = reCompile("[0-9]{1,2}/[0-9]{4}|[0-9]{4}-[0-9]{1,2}")
+# nombre d'utilisateurs gardés dans le cache des lectures et durée de vie en secondes de leurs entrées
+CACHE_TAILLE = 256
+CACHE_DUREE = 600
+# le registre des agences (table 'agences'), initialisé au lancement du bot et relu au plus toutes les AGENCES_DUREE secondes
+AGENCES = None
+AGENCES_DUREE = 300
+# administrateurs du bot (commande '/stats'), noms d'utilisateur ou identifiants telegram séparés par des virgules : 'admin={nom},{id}'
+REGEX_ADMIN = reCompile("admin=([a-zA-Z0-9_,]+)")
+# serveur http optionnel des mesures au format prometheus, activé avec 'metriques_port={port}' (écoute sur 'metriques_listen={adresse}')
+# et intervalle en secondes entre deux écritures des mesures dans les journaux, modifiable avec 'metriques_intervalle={secondes}' (0 : jamais)
+REGEX_METRIQUES_PORT = reCompile("metriques_port=[0-9]+")
+REGEX_METRIQUES_LISTEN = reCompile("metriques_listen=([0-9a-fA-F.:]+)")
+REGEX_METRIQUES_INTERVALLE = reCompile("metriques_intervalle=[0-9]+")
+METRIQUES_PORT = 0
+METRIQUES_LISTEN = "127.0.0.1"
+METRIQUES_INTERVALLE = 300
+# bornes en secondes des classes des histogrammes de durée, et durée au dela de laquelle une opération est signalée dans les journaux
+BORNES_DUREES = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DUREE_LENTE = 2
+# nombre de processus du bot (mode superviseur au dela de 1), chaque utilisateur est toujours traité par le meme processus
+REGEX_PROCESSUS = reCompile("processus=[0-9]+")
+PROCESSUS = 1
+# numéro du processus courant en mode superviseur (None sinon)
+PROCESSUS_NUMERO = None
+# intervalle en secondes de la surveillance des processus, et délai sans signe de vie avant de relancer un processus
+PROCESSUS_SURVEILLANCE = 5
+PROCESSUS_SILENCE = 60
+# nombre de lignes lues à la fois par les lectures parcourues (export excel)
+LOT_LECTURE = 500
 # la colonne maxi dans laquelle on va écrire les données sur excel (lié au modèle de suivi des fiches de paies)
 MAX_COL = 6
 
 
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~	   CONFIGURATION	   ~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+# les réglages du bot lus dans le .env, non modifiables une fois lus
+@dataclass(frozen=True)
+class parametres():
+	token: str = field(repr=False)
+	server_name: str
+	server_port: int
+	mail_from: str
+	mail_mdp: str = field(repr=False)
+	mail_to: str
+	mail_agences: MappingProxyType
+	mail_tls: int
+	mail_essais: int
+	mail_inactivite: int
+	bot_workers: int
+	export_workers: int
+	export_attente: int
+	persistance_intervalle: int
+	sqlite_maintenance: int
+	sqlite: MappingProxyType
+	webhook: MappingProxyType
+	admins: tuple
+	metriques_port: int
+	metriques_listen: str
+	metriques_intervalle: int
+	processus: int
+
+# lit le texte du .env, vérifie que les clefs obligatoires sont présentes et complète avec les valeurs par défaut
+def lecture_parametres(txt):
+	# les clefs obligatoires, 'clef=valeur'
+	obligatoires = {
+		"token": REGEX_TOKEN,
+		"server_name": REGEX_SVR_NAME,
+		"server_port": REGEX_SVR_PORT,
+		"mail_from": REGEX_MAIL_FROM,
+		"mail_mdp": REGEX_MAIL_MDP,
+		"mail_to": REGEX_MAIL_TO,
+	}
+	valeurs = {}
+	for nom, regex in obligatoires.items():
+		trouve = regex.findall(txt)
+		if trouve:
+			valeurs[nom] = trouve[0][len(nom)+1:]
+	manquantes = [k for k in obligatoires if k not in valeurs]
+	if manquantes:
+		raise Exit(f"[!] clefs absentes ou invalides dans le .env : {', '.join(manquantes)}")
+	# les clefs optionnelles, nombre entier 'clef=valeur' compris entre un minimum et un maximum
+	# (minimum 0 quand 0 désactive la fonction : serveur des mesures, écriture des mesures dans les journaux)
+	optionnelles = {
+		"mail_tls": (REGEX_MAIL_TLS, MAIL_TLS, 0, 1),
+		"mail_essais": (REGEX_MAIL_ESSAIS, MAIL_ESSAIS, 1, None),
+		"mail_inactivite": (REGEX_MAIL_INACTIVITE, MAIL_INACTIVITE, 1, None),
+		"bot_workers": (REGEX_WORKERS, WORKERS, 1, None),
+		"export_workers": (REGEX_EXPORT_WORKERS, EXPORT_WORKERS, 1, None),
+		"export_attente": (REGEX_EXPORT_ATTENTE, EXPORT_ATTENTE, 1, None),
+		"persistance_intervalle": (REGEX_PERSISTANCE, PERSISTANCE_INTERVALLE, 1, None),
+		"sqlite_maintenance": (REGEX_SQLITE_MAINTENANCE, MAINTENANCE_BDD, 1, None),
+		"metriques_port": (REGEX_METRIQUES_PORT, METRIQUES_PORT, 0, 65535),
+		"metriques_intervalle": (REGEX_METRIQUES_INTERVALLE, METRIQUES_INTERVALLE, 0, None),
+		"processus": (REGEX_PROCESSUS, PROCESSUS, 1, None),
+	}
+	invalides = []
+	for nom, (regex, defaut, mini, maxi) in optionnelles.items():
+		trouve = regex.findall(txt)
+		valeurs[nom] = int(trouve[0][len(nom)+1:]) if trouve else defaut
+		if valeurs[nom] < mini or (maxi is not None and valeurs[nom] > maxi):
+			invalides.append(f"{nom}={valeurs[nom]}")
+	valeurs["server_port"] = int(valeurs["server_port"])
+	if not 1 <= valeurs["server_port"] <= 65535:
+		invalides.append(f"server_port={valeurs['server_port']}")
+	if invalides:
+		raise Exit(f"[!] valeurs hors limites dans le .env : {', '.join(invalides)}")
+	# les destinataires par agence, les administrateurs, les réglages de sqlite, du webhook et du serveur des mesures
+	valeurs["mail_agences"] = MappingProxyType({k.replace("_", " "): v for k, v in REGEX_MAIL_AGENCE.findall(txt)})
+	valeurs["admins"] = tuple(k.lower() for k in ",".join(REGEX_ADMIN.findall(txt)).split(",") if k)
+	valeurs["metriques_listen"] = (REGEX_METRIQUES_LISTEN.findall(txt) or [METRIQUES_LISTEN])[0]
+	sqlite = dict(PRAGMAS_BDD)
+	sqlite.update(REGEX_SQLITE.findall(txt))
+	webhook = dict(WEBHOOK)
+	webhook.update(REGEX_WEBHOOK.findall(txt))
+	return parametres(sqlite=MappingProxyType(sqlite), webhook=MappingProxyType(webhook), **valeurs)
+
+# la configuration du bot : le .env est lu une seule fois, puis relu seulement si sa date de modification change
+class configuration():
+	# première lecture, les erreurs sont remontées dès le lancement
+	def __init__(self, FULLPATH):
+		self.fullpath = FULLPATH
+		self._lock = threading.Lock()
+		if not os.path.isfile(FULLPATH):
+			raise Exit("[!] le fichier .env contenant le token d'identitification n'existe pas")
+		self._mtime = os.stat(FULLPATH).st_mtime
+		with open(FULLPATH, "r") as f:
+			self._parametres = lecture_parametres(f.read())
+
+	# renvois les réglages à jour, la version précédente est gardée si le nouveau .env est invalide
+	def get(self):
+		try:
+			mtime = os.stat(self.fullpath).st_mtime
+		except OSError:
+			return self._parametres
+		if mtime != self._mtime:
+			with self._lock:
+				if mtime != self._mtime:
+					self._mtime = mtime
+					try:
+						with open(self.fullpath, "r") as f:
+							self._parametres = lecture_parametres(f.read())
+						LOG.info("configuration rechargée", extra={"donnees": {"fichier": self.fullpath}})
+					except Exit as e:
+						LOG.warning("configuration invalide, configuration précédente conservée", extra={"donnees": {"erreur": str(e)}})
+		return self._parametres
+
+
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~		  MESURES		   ~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+# une série de mesures de durée : nombre, erreurs, somme, extrémums et histogramme (classes délimitées par BORNES_DUREES)
+class serie():
+	# initialisation d'une série vide
+	def __init__(self):
+		self.nombre = 0
+		self.erreurs = 0
+		self.somme = 0.0
+		self.mini = float("inf")
+		self.maxi = 0.0
+		self.classes = [0] * (len(BORNES_DUREES) + 1)
+
+	# le quantile q (entre 0 et 1) en secondes, estimé par interpolation dans la classe qui le contient
+	def quantile(self, q):
+		return min(max(self._interpole(q), self.mini), self.maxi)
+
+	# interpolation linéaire dans la classe contenant le quantile q
+	def _interpole(self, q):
+		rang = q * self.nombre
+		cumul = 0
+		for k, n in enumerate(self.classes):
+			if n and cumul + n >= rang:
+				# au dela de la dernière borne, on renvois la dernière borne
+				if k == len(BORNES_DUREES):
+					return BORNES_DUREES[-1]
+				bas = BORNES_DUREES[k-1] if k > 0 else 0.0
+				return bas + (BORNES_DUREES[k] - bas) * (rang - cumul) / n
+			cumul += n
+		return 0.0
+
+# les mesures du bot, partagées par tous les threads : durées (handlers, requètes sql, envoi des mails, export excel)
+# et valeurs cumulées (taille des exports, lectures en cache)
+class mesures():
+	# initialisation des mesures
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._series = defaultdict(serie)
+		self._valeurs = defaultdict(lambda: [0, 0])
+		self.debut = monotonic()
+
+	# enregistre la durée en secondes d'une opération, les opérations trop longues sont signalées dans les journaux
+	def enregistre(self, nom, duree, erreur=False):
+		classe = bisect_left(BORNES_DUREES, duree)
+		with self._lock:
+			mesure = self._series[nom]
+			mesure.nombre += 1
+			mesure.erreurs += bool(erreur)
+			mesure.somme += duree
+			mesure.mini = min(mesure.mini, duree)
+			mesure.maxi = max(mesure.maxi, duree)
+			mesure.classes[classe] += 1
+		if duree > DUREE_LENTE:
+			LOG.warning("opération lente", extra={"donnees": {"nom": nom, "duree_ms": round(duree * 1000, 1), "erreur": bool(erreur)}})
+
+	# ajoute une valeur à un cumul
+	def ajoute(self, nom, valeur=1):
+		with self._lock:
+			cumul = self._valeurs[nom]
+			cumul[0] += 1
+			cumul[1] += valeur
+
+	# mesure la durée du bloc 'with', compté en erreur s'il lève une exception
+	@contextmanager
+	def mesure(self, nom):
+		debut = perf_counter()
+		try:
+			yield
+		except BaseException:
+			self.enregistre(nom, perf_counter() - debut, True)
+			raise
+		self.enregistre(nom, perf_counter() - debut)
+
+	# enveloppe une fonction pour mesurer chacun de ses appels
+	def instrumente(self, nom, fonction):
+		@wraps(fonction)
+		def enveloppe(*args, **kwargs):
+			with self.mesure(nom):
+				return fonction(*args, **kwargs)
+		return enveloppe
+
+	# une copie des mesures, durées en millisecondes
+	def resume(self):
+		with self._lock:
+			durees = {
+				nom: {
+					"nombre": k.nombre,
+					"erreurs": k.erreurs,
+					"moyenne_ms": round(k.somme / k.nombre * 1000, 2),
+					"p50_ms": round(k.quantile(0.5) * 1000, 2),
+					"p95_ms": round(k.quantile(0.95) * 1000, 2),
+					"p99_ms": round(k.quantile(0.99) * 1000, 2),
+				}
+				for nom, k in sorted(self._series.items())
+			}
+			valeurs = {nom: {"nombre": n, "somme": somme} for nom, (n, somme) in sorted(self._valeurs.items())}
+		return {"duree_s": round(monotonic() - self.debut), "durees": durees, "valeurs": valeurs}
+
+	# les mesures au format texte de prometheus
+	def prometheus(self):
+		with self._lock:
+			series = [(nom, k.nombre, k.erreurs, k.somme, list(k.classes)) for nom, k in sorted(self._series.items())]
+			valeurs = sorted((nom, n, somme) for nom, (n, somme) in self._valeurs.items())
+		lignes = [
+			"# HELP interimbot_duree_secondes durée des opérations du bot",
+			"# TYPE interimbot_duree_secondes histogram",
+		]
+		for nom, nombre, erreurs, somme, classes in series:
+			cumul = 0
+			for borne, n in zip(BORNES_DUREES, classes):
+				cumul += n
+				lignes.append(f'interimbot_duree_secondes_bucket{{nom="{nom}",le="{borne}"}} {cumul}')
+			lignes.append(f'interimbot_duree_secondes_bucket{{nom="{nom}",le="+Inf"}} {nombre}')
+			lignes.append(f'interimbot_duree_secondes_sum{{nom="{nom}"}} {somme}')
+			lignes.append(f'interimbot_duree_secondes_count{{nom="{nom}"}} {nombre}')
+		lignes += ["# HELP interimbot_erreurs_total opérations terminées en erreur", "# TYPE interimbot_erreurs_total counter"]
+		lignes += [f'interimbot_erreurs_total{{nom="{nom}"}} {erreurs}' for nom, _, erreurs, _, _ in series]
+		lignes += ["# HELP interimbot_valeurs_total cumul des valeurs mesurées", "# TYPE interimbot_valeurs_total counter"]
+		lignes += [f'interimbot_valeurs_total{{nom="{nom}"}} {somme}' for nom, _, somme in valeurs]
+		lignes += ["# HELP interimbot_valeurs_count nombre de valeurs mesurées", "# TYPE interimbot_valeurs_count counter"]
+		lignes += [f'interimbot_valeurs_count{{nom="{nom}"}} {n}' for nom, n, _ in valeurs]
+		return "\n".join(lignes) + "\n"
+
+# les journaux du bot au format json, une ligne par évènement (les données de 'extra={"donnees": {...}}' sont ajoutées à la ligne)
+class format_json(logging.Formatter):
+	# en mode superviseur, le numéro du processus est ajouté à chaque ligne
+	def __init__(self, processus=None):
+		super().__init__()
+		self.processus = processus
+
+	def format(self, record):
+		ligne = {"date": self.formatTime(record), "niveau": record.levelname, "source": record.name, "message": record.getMessage()}
+		if self.processus is not None:
+			ligne["processus"] = self.processus
+		ligne.update(getattr(record, "donnees", {}))
+		if record.exc_info:
+			ligne["exception"] = self.formatException(record.exc_info)
+		return json.dumps(ligne, ensure_ascii=False, default=str)
+
+# mesure la durée des méthodes de obj_bdd (exécution des requètes et lecture des résultats) sous le nom 'sql.{méthode}'
+def mesure_sql(methode):
+	return METRIQUES.instrumente(f"sql.{methode.__name__}", methode)
+
+# enveloppe les callbacks de tous les handlers du dispatcher, y compris ceux des conversations, pour les mesurer ('handler.{fonction}')
+def instrumente_handlers(dispatcher):
+	for groupe in dispatcher.handlers.values():
+		for handler in groupe:
+			if isinstance(handler, ConversationHandler):
+				handlers = handler.entry_points + [k for etat in handler.states.values() for k in etat] + handler.fallbacks
+			else:
+				handlers = [handler]
+			for k in handlers:
+				k.callback = METRIQUES.instrumente(f"handler.{k.callback.__qualname__}", k.callback)
+
+# lance le serveur http des mesures au format prometheus, sur '/metrics'
+def serveur_mesures(listen, port):
+	from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+	class requete(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path != "/metrics":
+				self.send_error(404)
+				return
+			corps = METRIQUES.prometheus().encode()
+			self.send_response(200)
+			self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+			self.send_header("Content-Length", str(len(corps)))
+			self.end_headers()
+			self.wfile.write(corps)
+		# pas de journal pour chaque requète
+		def log_message(self, format, *args):
+			pass
+	serveur = ThreadingHTTPServer((listen, port), requete)
+	threading.Thread(target=serveur.serve_forever, name="mesures", daemon=True).start()
+	return serveur
+
+# les mesures et le journal du bot
+METRIQUES = mesures()
+LOG = logging.getLogger("interimBot")
+
+
 ## ~~~~~~~~~~~~~~~~~~~~~~~~~~	  GESTION DU SQL	   ~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
 
+# migrations successives du schéma de la table, la version atteinte est enregistrée dans 'PRAGMA user_version'
+#  - 1 : création de la table
+#  - 2 : champs contrôlés, dates au format ISO 'AAAA-MM-JJ' et index (username, date) pour les listes triées
+#  - 3 : table de persistance des conversations et des données utilisateurs du bot
+#  - 4 : index (username, date, id) pour la pagination par position
+#  - 5 : index (username, agence, date, id) pour la pagination filtrée par agence
+#  - 6 : registre des agences (titre des sections, destinataire des mails, ordre des sections), avec les deux agences historiques
+MIGRATIONS = [
+	[
+		"CREATE TABLE IF NOT EXISTS '{table}' ('id' TEXT PRIMARY KEY, 'username' TEXT, 'agence' TEXT, 'date' TEXT, 'lieu' TEXT, 'heure_debut' TEXT, 'heure_fin' TEXT)",
+	],
+	[
+		"CREATE TABLE '{table}_v2' ("
+			"'id' TEXT PRIMARY KEY NOT NULL, "
+			"'username' TEXT NOT NULL, "
+			"'agence' TEXT NOT NULL, "
+			"'date' TEXT NOT NULL CHECK (date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'), "
+			"'lieu' TEXT NOT NULL, "
+			"'heure_debut' TEXT NOT NULL CHECK (heure_debut GLOB '[0-9][0-9]:[0-9][0-9]'), "
+			"'heure_fin' TEXT NOT NULL CHECK (heure_fin GLOB '[0-9][0-9]:[0-9][0-9]'))",
+		"INSERT INTO '{table}_v2' SELECT id, username, agence, replace(date, '/', '-'), lieu, heure_debut, heure_fin FROM '{table}'",
+		"DROP TABLE '{table}'",
+		"ALTER TABLE '{table}_v2' RENAME TO '{table}'",
+		"CREATE INDEX IF NOT EXISTS 'idx_{table}_username_date' ON '{table}' (username, date)",
+	],
+	[
+		"CREATE TABLE IF NOT EXISTS 'persistance' ('type' TEXT NOT NULL, 'nom' TEXT NOT NULL, 'clef' TEXT NOT NULL, 'valeur' TEXT NOT NULL, PRIMARY KEY (type, nom, clef))",
+	],
+	[
+		"CREATE INDEX IF NOT EXISTS 'idx_{table}_username_date_id' ON '{table}' (username, date, id)",
+		"DROP INDEX IF EXISTS 'idx_{table}_username_date'",
+	],
+	[
+		"CREATE INDEX IF NOT EXISTS 'idx_{table}_username_agence_date_id' ON '{table}' (username, agence, date, id)",
+	],
+	[
+		"CREATE TABLE IF NOT EXISTS 'agences' ('nom' TEXT NOT NULL PRIMARY KEY, 'titre' TEXT NOT NULL, 'mail_to' TEXT, 'ordre' INTEGER NOT NULL DEFAULT 0)",
+		"INSERT OR IGNORE INTO 'agences' (nom, titre, mail_to, ordre) VALUES ('appel medical', 'Appel Medical', NULL, 0), ('adecco', 'adecco', NULL, 1)",
+	],
+]
+
+# le cache des lectures par utilisateur (liste des missions, nombre, pages), partagé entre les threads du pool
+# taille limitée (les utilisateurs les moins récents sont oubliés) et durée de vie limitée des entrées
+# chaque utilisateur a un numéro de génération incrémenté quand ses entrées sont invalidées :
+# une lecture commencée avant l'invalidation n'est pas mise en cache
+class cache_bdd():
+	# initialisation du cache
+	def __init__(self, taille=CACHE_TAILLE, duree=CACHE_DUREE):
+		self._cache = TTLCache(taille, duree)
+		self._lock = threading.Lock()
+		self._generation = 0
+		self._generations = defaultdict(int)
+
+	# renvois la valeur en cache, sinon la lit avec la fonction 'lecture' et la met en cache
+	def lit(self, username, clef, lecture):
+		with self._lock:
+			entrees = self._cache.get(username)
+			if entrees is not None and clef in entrees:
+				METRIQUES.ajoute("cache.succes")
+				return entrees[clef]
+			generation = (self._generation, self._generations[username])
+		METRIQUES.ajoute("cache.echecs")
+		valeur = lecture()
+		with self._lock:
+			if (self._generation, self._generations[username]) == generation:
+				entrees = self._cache.get(username)
+				if entrees is None:
+					entrees = self._cache[username] = {}
+				entrees[clef] = valeur
+		return valeur
+
+	# oublie les entrées des utilisateurs donnés, None pour tout oublier
+	def invalide(self, usernames):
+		with self._lock:
+			if None in usernames:
+				self._generation += 1
+				self._cache.clear()
+				return
+			for username in usernames:
+				self._generations[username] += 1
+				self._cache.pop(username, None)
+
 # la classe qui va contenir la base de donnée
 class obj_bdd():
 	# fonction d'initialisation et de fermeture de la connection
-	def __init__(self, FULLPATH, tableName):
+	# si le schéma est fourni (connection empruntée au pool), la vérification de la table n'est pas refaite
+	# si un cache est fourni, les lectures par utilisateur y passent et les écritures l'invalident à la validation de la transaction
+	def __init__(self, FULLPATH, tableName, schema=None, pragmas=None, cache=None):
+		self.cache = cache
+		# les utilisateurs modifiés dans la transaction en cours (None : tous)
+		self._invalides = set()
 		try:
 			# si la base de donnée n'existe pas
 			if not os.path.isfile(FULLPATH):
 				with open(FULLPATH, "w+") as f:
 					pass
-			# curseur et connection de la base de donnée
-			self._conn = sqlite3.connect(FULLPATH)
+			# curseur et connection de la base de donnée (fermeture possible depuis un autre thread)
+			self._conn = sqlite3.connect(FULLPATH, check_same_thread=False)
 			self._cursor = self._conn.cursor()
-			# vérification du nom de la table
-			self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+			# réglages de la connection
+			self._reglages(pragmas)
+			# schéma déja vérifié
+			if schema is not None:
+				self.tableName, self.primaryKey, self.primaryKeyIndex, self.nomsColonnes = schema
+				return
+			# création ou mise à jour du schéma de la table
 			self.tableName = tableName
-			listeTable = [k[0] for k in self.cursor.fetchall()]
-			# si la table n'existe pas, on la crée
-			if self.tableName not in listeTable:
-				self.cursor.execute(f"CREATE TABLE IF NOT EXISTS '{tableName}' ('id' TEXT PRIMARY KEY, 'username' TEXT, 'agence' TEXT, 'date' TEXT, 'lieu' TEXT, 'heure_debut' TEXT, 'heure_fin' TEXT)")
+			self._migrate(FULLPATH)
 			# enregistrement de la clef primaire
-			self.primaryKey = None
-			self.cursor.execute(f"PRAGMA table_info({self.tableName})")
-			for k in self.cursor.fetchall():
-				if k[-1]:
-					self.primaryKey = k[1]
-					self.primaryKeyIndex = k[0]
-					break
+			self.primaryKey, self.primaryKeyIndex = self._clefPrimaire()
 			if self.primaryKey is None:
 				raise Exit(f"[!] la table '{self.tableName}' de la base de données '{FULLPATH}' n'a pas de clef primaire")
+			# enregistrement des noms des champs
+			self.nomsColonnes = self._namesColonnes()
 		# le chemin spécifié ne renvois vers rien
 		except sqlite3.OperationalError:
 			raise Exit(f"[!] la base de donnée '{FULLPATH}' est introuvable") # jamais trigger car connect crée automatiquement un fichier
@@ -107,207 +602,1012 @@ class obj_bdd():
 	@property
 	def cursor(self):
 		return self._cursor
+	@property
+	def schema(self):
+		return (self.tableName, self.primaryKey, self.primaryKeyIndex, self.nomsColonnes)
+
+	# applique les réglages (pragmas) de la connection
+	@mesure_sql
+	def _reglages(self, pragmas):
+		for nom, valeur in (pragmas or {}).items():
+			self.cursor.execute(f"PRAGMA {nom} = {valeur}")
+
+	# applique les migrations du schéma pas encore appliquées, chacune dans sa propre transaction
+	@mesure_sql
+	def _migrate(self, FULLPATH):
+		self.cursor.execute("PRAGMA user_version")
+		version = self.cursor.fetchone()[0]
+		for k in range(version, len(MIGRATIONS)):
+			try:
+				self.cursor.execute("BEGIN")
+				for requete in MIGRATIONS[k]:
+					self.cursor.execute(requete.format(table=self.tableName))
+				self.cursor.execute(f"PRAGMA user_version = {k+1}")
+				self.connection.commit()
+			except sqlite3.DatabaseError as e:
+				self.connection.rollback()
+				raise Exit(f"[!] échec de la migration n°{k+1} de la base de donnée '{FULLPATH}' : {e}")
+			LOG.info("base de donnée migrée", extra={"donnees": {"fichier": FULLPATH, "version": k+1}})
+
+	# lecture en passant par le cache, sauf si l'utilisateur a des modifications pas encore validées dans cette connection
+	def _lecture(self, username, clef, lecture):
+		if self.cache is None or None in self._invalides or username in self._invalides:
+			return lecture()
+		return self.cache.lit(username, clef, lecture)
+
+	# note qu'un utilisateur (None : tous) est modifié par la transaction en cours
+	def _modifie(self, username):
+		self._invalides.add(None if username is None else str(username).lower())
+
+	# récupere le nom et la position de la clef primaire de la table, (None, None) si elle n'en a pas
+	@mesure_sql
+	def _clefPrimaire(self):
+		self.cursor.execute(f"PRAGMA table_info({self.tableName})")
+		for k in self.cursor.fetchall():
+			if k[-1]:
+				return k[1], k[0]
+		return None, None
 
 	# récupere les noms des champs de la table
+	@mesure_sql
 	def _namesColonnes(self):
 		self.cursor.execute(f"PRAGMA table_info({self.tableName})")
 		L = [k[1] for k in self.cursor.fetchall()]
 		return L
 
-	# renvois True si l'entrée de la clef primaire est bien présente dans la table
-	def _verify(self, key, prefixe, suffixe):
+	# vérifie qu'un nom de champ fait bien partie de la table (les noms ne peuvent pas etre passés en paramètre)
+	def _verifyColonne(self, nom):
+		if nom not in self.nomsColonnes:
+			raise Exit(f"[!] le champ '{nom}' n'existe pas dans la table '{self.tableName}'")
+		return nom
+
+	# mise en forme des valeurs avant de les lier à une requète
+	# seul le texte "NULL" devient NULL : None est enregistré en texte ('none'), comme le nom des utilisateurs telegram sans username
+	def _valeurs(self, valeurs, lower):
+		nomsColonnes = self.nomsColonnes
+		if len(valeurs) != len(nomsColonnes):
+			raise Exit(f"[!] les arguments {valeurs} ne correspondent pas au colonnes {nomsColonnes}")
+		L = []
+		for k in valeurs:
+			if k == "NULL":
+				L.append(None)
+			elif lower:
+				L.append(str(k).lower())
+			else:
+				L.append(k)
+		return L
+
+	# recherche approchée (insensible à la casse) sur un champ, clef primaire par défaut
+	@mesure_sql
+	def search(self, key, prefixe, suffixe, keyname=None):
+		if not keyname:
+			keyname = self.primaryKey
+		# les caractères spéciaux de LIKE présents dans la clef sont recherchés tels quels
+		key = str(key).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
 		# si prefixe et suffixe valent False, la clef doit exactement etre présente
 		if not prefixe and not suffixe:
-			self.cursor.execute(f"SELECT {self.primaryKey} FROM {self.tableName} WHERE {self.primaryKey} LIKE '{key}'")
+			motif = key
 		# si seul prefixe vaut True, la clef doit seulement commencer pareil
 		elif prefixe and not suffixe:
-			self.cursor.execute(f"SELECT {self.primaryKey} FROM {self.tableName} WHERE {self.primaryKey} LIKE '{key}%'")
+			motif = f"{key}%"
 		# si seul suffixe vaut True, la clef doit seulement finir pareil
 		elif not prefixe and suffixe:
-			self.cursor.execute(f"SELECT {self.primaryKey} FROM {self.tableName} WHERE {self.primaryKey} LIKE '%{key}'")
+			motif = f"%{key}"
 		# si prefixe et suffixe valent True, la clef doit etre contenue
 		else:
-			self.cursor.execute(f"SELECT {self.primaryKey} FROM {self.tableName} WHERE {self.primaryKey} LIKE '%{key}%'")
-
-		# resultat
-		if self.cursor.fetchall() == []:
-			return False
-		else:
-			return True
+			motif = f"%{key}%"
+		self.cursor.execute(f"SELECT * FROM {self.tableName} WHERE {self._verifyColonne(keyname)} LIKE ? ESCAPE '\\'", (motif,))
+		return self.cursor.fetchall()
 
 	# recuperer les infos pour une entrée de clef (primaire par défaut) donnée. Si c'est "all", renvoit la totalité des données de la table
+	# les valeurs étant enregistrées en minuscules, la recherche exacte se fait sur les valeurs mises en minuscules
+	@mesure_sql
 	def getDatas(self, username, key, keyname=None, order="date"):
 		if not keyname:
 			keyname = self.primaryKey
 		if key == "all":
-			self.cursor.execute(f"SELECT * FROM {self.tableName} WHERE username LIKE '{username}' ORDER BY {order} ASC")
-			return self.cursor.fetchall()
+			username = str(username).lower()
+			requete = f"SELECT * FROM {self.tableName} WHERE username = ? ORDER BY {self._verifyColonne(order)} ASC"
+			return list(self._lecture(username, ("all", order), lambda: tuple(self.cursor.execute(requete, (username,)).fetchall())))
 		else:
-			self.cursor.execute(f"SELECT * FROM {self.tableName} WHERE username LIKE '{username}' AND {keyname} LIKE '{key}'")
+			self.cursor.execute(f"SELECT * FROM {self.tableName} WHERE username = ? AND {self._verifyColonne(keyname)} = ?", (str(username).lower(), str(key).lower()))
 			return self.cursor.fetchone()
 
-	# ajoute une nouvelle entrée dans la base de données
+	# le nombre d'entrées d'un utilisateur
+	@mesure_sql
+	def compte(self, username):
+		username = str(username).lower()
+		requete = f"SELECT count(*) FROM {self.tableName} WHERE username = ?"
+		return self._lecture(username, "compte", lambda: self.cursor.execute(requete, (username,)).fetchone()[0])
+
+	# une page d'au plus 'taille' entrées d'un utilisateur dans l'ordre (date, id), après ou avant une position (date, id) exclue
+	# filtrable par mois ('AAAA-MM') et par agence, renvois les entrées dans l'ordre chronologique et si d'autres entrées existent au dela de la page
+	@mesure_sql
+	def getPage(self, username, taille, apres=None, avant=None, mois=None, agence=None):
+		username = str(username).lower()
+		clef = ("page", taille, apres and tuple(apres), avant and tuple(avant), mois, agence)
+		page, encore = self._lecture(username, clef, lambda: self._page(username, taille, apres, avant, mois, agence))
+		return list(page), encore
+
+	# la requète d'une page, voir getPage
+	def _page(self, username, taille, apres, avant, mois, agence):
+		conditions = ["username = ?"]
+		parametres = [username]
+		# un mois correspond à l'intervalle de dates [AAAA-MM-01, mois suivant[
+		if mois is not None:
+			annee, numero = int(mois[:4]), int(mois[5:7])
+			conditions.append("date >= ? AND date < ?")
+			parametres += [f"{annee:04d}-{numero:02d}-01", f"{annee + numero // 12:04d}-{numero % 12 + 1:02d}-01"]
+		if agence is not None:
+			conditions.append("agence = ?")
+			parametres.append(agence.lower())
+		# la position de départ et le sens du tri
+		ordre = "ASC"
+		if avant is not None:
+			conditions.append(f"(date, {self.primaryKey}) < (?, ?)")
+			parametres += list(avant)
+			ordre = "DESC"
+		elif apres is not None:
+			conditions.append(f"(date, {self.primaryKey}) > (?, ?)")
+			parametres += list(apres)
+		self.cursor.execute(f"SELECT * FROM {self.tableName} WHERE {' AND '.join(conditions)} ORDER BY date {ordre}, {self.primaryKey} {ordre} LIMIT ?", (*parametres, taille + 1))
+		page = self.cursor.fetchall()
+		encore = len(page) > taille
+		page = page[:taille]
+		if avant is not None:
+			page.reverse()
+		return tuple(page), encore
+
+	# parcourt sans tout charger en mémoire les entrées d'un utilisateur, regroupées par agence dans l'ordre du registre puis triées par date
+	# les agences absentes du registre viennent en dernier, par ordre alphabétique
+	# la mesure 'sql.iterDatas' compte la requète et la lecture des lignes, pas le traitement des lignes par l'appelant
+	def iterDatas(self, username):
+		duree, erreur = 0.0, False
+		debut = perf_counter()
+		try:
+			curseur = self.connection.execute(
+				f"SELECT m.* FROM {self.tableName} AS m LEFT JOIN agences AS a ON a.nom = m.agence "
+				"WHERE m.username = ? ORDER BY a.ordre IS NULL, a.ordre, m.agence, m.date ASC",
+				(str(username).lower(),)
+			)
+			while True:
+				lignes = curseur.fetchmany(LOT_LECTURE)
+				duree += perf_counter() - debut
+				if not lignes:
+					break
+				yield from lignes
+				debut = perf_counter()
+		except sqlite3.Error:
+			erreur = True
+			duree += perf_counter() - debut
+			raise
+		finally:
+			METRIQUES.enregistre("sql.iterDatas", duree, erreur)
+
+	# les agences du registre : rowid, nom, titre, destinataire des mails, dans l'ordre des sections
+	@mesure_sql
+	def getAgences(self):
+		self.cursor.execute("SELECT rowid, nom, titre, mail_to FROM agences ORDER BY ordre, nom")
+		return self.cursor.fetchall()
+
+	# ajoute une nouvelle entrée dans la base de données, une seule requète qui ne fait rien si la clef existe déja
+	@mesure_sql
 	def create(self, valeurs, lower=True):
-		nomsColonnes = self._namesColonnes()
-		if len(valeurs) != len(nomsColonnes):
-			raise Exit(f"[!] les arguments {valeurs} ne correspondent pas au colonnes {nomsColonnes}")
-		# on vérifie que l'entrée n'existe pas déja
-		if not self._verify(valeurs[self.primaryKeyIndex], False, False):
-			text = f"INSERT INTO {self.tableName}("
-			for k in nomsColonnes:
-				text += f"{k},"
-			text = f"{text[:-1]}) VALUES("
-			for k in valeurs:
-				if k == "NULL":
-					text += "NULL,"
-				elif lower:
-					text += f"'{str(k).lower()}',"
-				else:
-					text += f"'{k}',"
-			text = f"{text[:-1]})"
-			try:
-				self.cursor.execute(text)
-			except sqlite3.OperationalError as e:
-				raise Exit(f"[!] erreur dans l'opération : {e}")
-		else:
+		valeurs = self._valeurs(valeurs, lower)
+		self._modifie(valeurs[self.nomsColonnes.index("username")])
+		try:
+			self.cursor.execute(self._insertSql(), valeurs)
+		except (sqlite3.OperationalError, sqlite3.IntegrityError) as e:
+			raise Exit(f"[!] erreur dans l'opération : {e}")
+		if self.cursor.rowcount == 0:
 			raise Exit(f"[!] {self.primaryKey} = {valeurs[self.primaryKeyIndex]}, cette entrée existe déjà")
 
-	# supprime une entrée en la selectionnant avec la clef primaire
-	def delete(self, key):
-		# on vérifie que l'entrée existe
-		if self._verify(key, False, False):
-			self.cursor.execute(f"DELETE FROM {self.tableName} WHERE {self.primaryKey}='{key}'")
+	# ajoute plusieurs entrées d'un coup avec une seule requète préparée, renvois le nombre d'entrées ajoutées
+	@mesure_sql
+	def createMany(self, listeValeurs, lower=True):
+		listeValeurs = [self._valeurs(k, lower) for k in listeValeurs]
+		for k in listeValeurs:
+			self._modifie(k[self.nomsColonnes.index("username")])
+		try:
+			self.cursor.executemany(self._insertSql(), listeValeurs)
+		except (sqlite3.OperationalError, sqlite3.IntegrityError) as e:
+			raise Exit(f"[!] erreur dans l'opération : {e}")
+		return self.cursor.rowcount
+
+	# la requète d'insertion, identique pour toutes les entrées, ignorée si la clef primaire existe déja
+	def _insertSql(self):
+		return (
+			f"INSERT INTO {self.tableName}({', '.join(self.nomsColonnes)}) VALUES({', '.join('?' * len(self.nomsColonnes))}) "
+			f"ON CONFLICT({self.primaryKey}) DO NOTHING"
+		)
+
+	# supprime une entrée en la selectionnant avec la clef primaire, seulement parmi celles de l'utilisateur s'il est donné
+	@mesure_sql
+	def delete(self, key, username=None):
+		self._modifie(username)
+		if username is None:
+			self.cursor.execute(f"DELETE FROM {self.tableName} WHERE {self.primaryKey} = ?", (key,))
 		else:
+			self.cursor.execute(f"DELETE FROM {self.tableName} WHERE {self.primaryKey} = ? AND username = ?", (key, str(username).lower()))
+		if self.cursor.rowcount == 0:
 			raise Exit(f"[!] {self.primaryKey} = {key}, pas d'entrée corespondante")
 
+	# supprime plusieurs entrées avec une seule requète préparée, renvois le nombre d'entrées supprimées
+	@mesure_sql
+	def deleteMany(self, keys):
+		self._modifie(None)
+		self.cursor.executemany(f"DELETE FROM {self.tableName} WHERE {self.primaryKey} = ?", [(k,) for k in keys])
+		return self.cursor.rowcount
+
+	# supprime en une requète les entrées d'un utilisateur (toutes, ou seulement celles des clefs données), renvois le nombre d'entrées supprimées
+	# les clefs sont envoyées par paquets pour rester sous la limite de paramètres de sqlite
+	@mesure_sql
+	def purge(self, username, keys=None):
+		username = str(username).lower()
+		self._modifie(username)
+		if keys is None:
+			self.cursor.execute(f"DELETE FROM {self.tableName} WHERE username = ?", (username,))
+			return self.cursor.rowcount
+		keys = list(keys)
+		nb = 0
+		for k in range(0, len(keys), 500):
+			paquet = keys[k:k+500]
+			self.cursor.execute(f"DELETE FROM {self.tableName} WHERE username = ? AND {self.primaryKey} IN ({', '.join('?' * len(paquet))})", [username] + paquet)
+			nb += self.cursor.rowcount
+		return nb
+
 	# modifie une entrée en la selectionnant avec la clef primaire (dans le champ valeurs)
+	@mesure_sql
 	def modify(self, valeurs, lower):
-		nomsColonnes = self._namesColonnes()
-		if len(valeurs) != len(nomsColonnes):
-			raise Exit(f"[!] les arguments {valeurs} ne correspondent pas au colonnes {nomsColonnes}")
-		# on vérifie que l'entrée existe
-		if self._verify(valeurs[self.primaryKeyIndex], False, False):
-			text = f"UPDATE {self.tableName} SET"
-			for k in range(len(nomsColonnes)):
-				if lower:
-					text += f" {nomsColonnes[k]}='{str(valeurs[k]).lower()}',"
-				else:
-					text += f" {nomsColonnes[k]}='{valeurs[k]}',"
-			text = f"{text[:-1]} WHERE {self.primaryKey} = '{valeurs[self.primaryKeyIndex]}'"
-			try:
-				self.cursor.execute(text)
-			except sqlite3.OperationalError as e:
-				raise Exit(f"[!] erreur dans l'opération : {e}")
-		else:
+		valeurs = self._valeurs(valeurs, lower)
+		self._modifie(valeurs[self.nomsColonnes.index("username")])
+		text = f"UPDATE {self.tableName} SET {', '.join(f'{k} = ?' for k in self.nomsColonnes)} WHERE {self.primaryKey} = ?"
+		try:
+			self.cursor.execute(text, valeurs + [valeurs[self.primaryKeyIndex]])
+		except (sqlite3.OperationalError, sqlite3.IntegrityError) as e:
+			raise Exit(f"[!] erreur dans l'opération : {e}")
+		if self.cursor.rowcount == 0:
 			raise Exit(f"[!] {self.primaryKey} = {valeurs[self.primaryKeyIndex]}, pas d'entrée correspondante")
 
-	# sauvegarde la base de donnée
+	# recopie le journal WAL dans la base et met à jour les statistiques des index
+	@mesure_sql
+	def maintenance(self):
+		self.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+		resultat = self.cursor.fetchone()
+		self.cursor.execute("PRAGMA optimize")
+		return resultat
+
+	# sauvegarde la base de donnée, puis invalide le cache des utilisateurs modifiés
+	@mesure_sql
 	def save(self):
 		self.connection.commit()
+		self._invalide()
+
+	# annule la transaction en cours (le cache a pu etre rempli avec des lectures non validées)
+	@mesure_sql
+	def rollback(self):
+		self.connection.rollback()
+		self._invalide()
+
+	# oublie les entrées en cache des utilisateurs modifiés
+	def _invalide(self):
+		if self._invalides:
+			if self.cache is not None:
+				self.cache.invalide(self._invalides)
+			self._invalides = set()
 
 	# ferme la base de donnée
 	def close(self):
 		self.cursor.close()
 		self.connection.close()
 
+# le pool de connections partagé par les handlers : une connection par thread (dispatcher, job queue)
+# ouverte à la première utilisation puis réutilisée, le schéma n'est vérifié qu'une seule fois au démarrage
+class pool_bdd():
+	# vérification de la table et initialisation du pool et de son cache
+	def __init__(self, FULLPATH, tableName, pragmas=None):
+		self.fullpath = FULLPATH
+		self.pragmas = pragmas
+		self.cache = cache_bdd()
+		with obj_bdd(FULLPATH, tableName, pragmas=pragmas) as temp_bdd:
+			self.schema = temp_bdd.schema
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._connections = []
+
+	# emprunte la connection du thread courant, sauvegarde à la sortie du 'with' (annule si erreur)
+	@contextmanager
+	def borrow(self):
+		bdd = getattr(self._local, "bdd", None)
+		if bdd is None:
+			bdd = obj_bdd(self.fullpath, self.schema[0], self.schema, self.pragmas, self.cache)
+			self._local.bdd = bdd
+			with self._lock:
+				self._connections.append(bdd)
+		try:
+			yield bdd
+		except BaseException:
+			bdd.rollback()
+			raise
+		else:
+			bdd.save()
+
+	# ferme toutes les connections ouvertes
+	def close(self):
+		with self._lock:
+			for bdd in self._connections:
+				bdd.close()
+			self._connections = []
+		self._local = threading.local()
+
+
+# une agence du registre, 'numero' est le rowid de la table (stable, utilisé dans les boutons inline)
+@dataclass(frozen=True)
+class agence():
+	numero: int
+	nom: str
+	titre: str
+	mail_to: str = None
+
+# le registre des agences lu dans la table 'agences', relu au plus toutes les 'duree' secondes
+# pour ajouter une agence : INSERT INTO agences (nom, titre, mail_to, ordre) VALUES (...)
+class registre_agences():
+	# initialisation et première lecture
+	def __init__(self, pool, duree=AGENCES_DUREE):
+		self.pool = pool
+		self.duree = duree
+		self._lock = threading.Lock()
+		self._lecture = None
+		self._agences = ()
+		self.get()
+
+	# les agences dans l'ordre des sections, relues si la dernière lecture est trop ancienne
+	def get(self):
+		with self._lock:
+			if self._lecture is None or monotonic() - self._lecture > self.duree:
+				with self.pool.borrow() as temp_bdd:
+					self._agences = tuple(agence(*k) for k in temp_bdd.getAgences())
+				self._lecture = monotonic()
+			return self._agences
+
+	# les noms des agences
+	def noms(self):
+		return [k.nom for k in self.get()]
+
+	# l'agence d'un nom ou d'un numéro, None si elle n'est pas dans le registre
+	def cherche(self, nom=None, numero=None):
+		for k in self.get():
+			if k.nom == nom or k.numero == numero:
+				return k
+		return None
+
+	# les agences des noms donnés dans l'ordre des sections, les agences absentes du registre à la fin par ordre alphabétique
+	def sections(self, noms):
+		noms = set(noms)
+		connues = [k for k in self.get() if k.nom in noms]
+		inconnues = [agence(None, k, k) for k in sorted(noms - {k.nom for k in connues})]
+		return connues + inconnues
+
+
+# la persistance des conversations en cours et des données utilisateurs dans la table 'persistance' de la base de donnée
+# les modifications sont gardées en mémoire et écrites par paquets à chaque appel de flush (job périodique et arret du bot)
+class persistance_bdd(BasePersistence):
+	# chargement de l'état sauvegardé
+	def __init__(self, pool):
+		super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+		self.pool = pool
+		self._lock = threading.Lock()
+		self._user_data = defaultdict(dict)
+		self._conversations = defaultdict(dict)
+		# les entrées modifiées depuis la dernière écriture
+		self._sales = set()
+		# la dernière promesse (handler run_async en cours) de chaque conversation
+		self._promesses = {}
+		with METRIQUES.mesure("sql.persistance_lecture"), self.pool.borrow() as temp_bdd:
+			temp_bdd.cursor.execute("SELECT type, nom, clef, valeur FROM persistance")
+			for type, nom, clef, valeur in temp_bdd.cursor.fetchall():
+				if type == "user_data":
+					self._user_data[int(clef)] = json.loads(valeur)
+				elif type == "conversation":
+					self._conversations[nom][tuple(json.loads(clef))] = json.loads(valeur)
+
+	# les données utilisateurs
+	def get_user_data(self):
+		with self._lock:
+			return defaultdict(dict, {k: dict(v) for k, v in self._user_data.items()})
+
+	# les données des chats ne sont pas utilisées
+	def get_chat_data(self):
+		return defaultdict(dict)
+
+	# les données du bot ne sont pas utilisées
+	def get_bot_data(self):
+		return {}
+
+	# les états d'une conversation
+	def get_conversations(self, name):
+		with self._lock:
+			return dict(self._conversations[name])
+
+	# enregistre en mémoire le nouvel état d'une conversation
+	def update_conversation(self, name, key, new_state):
+		# si le handler est encore en cours (run_async), telegram donne (ancien état, promesse) jusqu'au message suivant de
+		# l'utilisateur : l'ancien état est gardé, puis remplacé par le résultat du handler dès qu'il est terminé
+		# (les tuples sont imbriqués quand l'ancien état était lui-meme en attente, la promesse est toujours la plus récente)
+		promesse = None
+		if isinstance(new_state, tuple):
+			promesse = new_state[1]
+			while isinstance(new_state, tuple):
+				new_state = new_state[0]
+		with self._lock:
+			self._promesses[(name, key)] = promesse
+			self._modifie_conversation(name, key, new_state)
+		# les conversations n'ont pas de timeout, le callback de la promesse n'est pas utilisé par telegram
+		if promesse is not None:
+			promesse.add_done_callback(lambda resultat: self._termine(name, key, promesse, resultat))
+
+	# enregistre le résultat d'un handler run_async, s'il n'a pas été remplacé entre temps par un état plus récent
+	# (un handler qui renvoit None ne change pas l'état, ConversationHandler.END termine la conversation)
+	def _termine(self, name, key, promesse, resultat):
+		with self._lock:
+			if self._promesses.get((name, key)) is not promesse:
+				return
+			self._promesses[(name, key)] = None
+			if resultat is None:
+				return
+			self._modifie_conversation(name, key, None if resultat == ConversationHandler.END else resultat)
+
+	# modifie l'état d'une conversation et la marque à écrire, appelée avec le verrou
+	def _modifie_conversation(self, name, key, etat):
+		if self._conversations[name].get(key) == etat:
+			return
+		if etat is None:
+			self._conversations[name].pop(key, None)
+		else:
+			self._conversations[name][key] = etat
+		self._sales.add(("conversation", name, key))
+
+	# enregistre en mémoire les données d'un utilisateur
+	def update_user_data(self, user_id, data):
+		with self._lock:
+			if self._user_data.get(user_id) == data:
+				return
+			self._user_data[user_id] = data
+			self._sales.add(("user_data", "", user_id))
+
+	# les données des chats ne sont pas utilisées
+	def update_chat_data(self, chat_id, data):
+		pass
+
+	# les données du bot ne sont pas utilisées
+	def update_bot_data(self, data):
+		pass
+
+	# écrit en une transaction toutes les modifications faites depuis la dernière écriture
+	def flush(self):
+		with self._lock:
+			sales, self._sales = self._sales, set()
+			aEcrire, aSupprimer = [], []
+			for type, nom, clef in sales:
+				if type == "user_data":
+					# les données vides ne sont pas gardées
+					valeur = self._user_data.get(clef) or None
+					clef = str(clef)
+				else:
+					valeur = self._conversations[nom].get(clef)
+					clef = json.dumps(list(clef))
+				# l'état 0 (AGENCE) est un état valide
+				if valeur is not None:
+					aEcrire.append((type, nom, clef, json.dumps(valeur)))
+				else:
+					aSupprimer.append((type, nom, clef))
+		if not aEcrire and not aSupprimer:
+			return
+		try:
+			# la mesure compte aussi le commit fait en rendant la connection
+			with METRIQUES.mesure("sql.persistance_ecriture"), self.pool.borrow() as temp_bdd:
+				temp_bdd.cursor.executemany("INSERT OR REPLACE INTO persistance(type, nom, clef, valeur) VALUES(?, ?, ?, ?)", aEcrire)
+				temp_bdd.cursor.executemany("DELETE FROM persistance WHERE type = ? AND nom = ? AND clef = ?", aSupprimer)
+		# écriture impossible (base verrouillée...) : les entrées restent à écrire au prochain appel
+		except BaseException:
+			with self._lock:
+				self._sales |= sales
+			raise
+
 
 ## ~~~~~~~~~~~~~~~~~~~~~~~~~~	FILTRE MESSAGE PERSO   ~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
 
 # classe de filtres personalisés
 class filtres_perso:
-	# detection des dates possibles
+	# detection des dates possibles ('12 05 2022', '12/05/2022', '12-05-22', ...), la date ISO est passée au handler dans context.date
 	class _date(MessageFilter):
+		data_filter = True
 		def filter(self, message):
 			if message.text:
-				try:
-					temp = dt.strptime(message.text, "%d %m %Y")
-					return True
-				except ValueError:
-					return False
+				date = lit_date(message.text)
+				if date is not None:
+					return {"date": [date]}
+			return False
 	date = _date()
 
-	# detection des heures possibles
+	# detection des heures possibles ('08 30', '8:30', '8h30', '8h', ...), l'heure 'HH:MM' est passée au handler dans context.heure
 	class _heure(MessageFilter):
+		data_filter = True
 		def filter(self, message):
 			if message.text:
-				try:
-					temp = dt.strptime(message.text, "%H %M")
-					return True
-				except ValueError:
-					return False
+				heure = lit_heure(message.text)
+				if heure is not None:
+					return {"heure": [heure]}
+			return False
 	heure = _heure()
 
 	# detection des agences possibles
 	class _agence(MessageFilter):
 		def filter(self, message):
 			if message.text:
-				if message.text in ["appel medical", "adecco"]:
+				if message.text in AGENCES.noms():
 					return True
 				return False
 	agence = _agence()
 
+# formats acceptés des dates (jour, mois, année sur 2 ou 4 chiffres) et des heures (heure, minutes optionnelles après 'h')
+REGEX_DATE = reCompile(r" *([0-9]{1,2}) *[ /.-] *([0-9]{1,2}) *[ /.-] *([0-9]{4}|[0-9]{2}) *")
+REGEX_HEURE = reCompile(r" *([01]?[0-9]|2[0-3]) *(?:[ :] *([0-5][0-9])|[hH] *([0-5][0-9])?) *")
+
+# renvois la date ISO 'AAAA-MM-JJ' d'un texte, None si ce n'est pas une date valide
+@lru_cache(maxsize=1024)
+def lit_date(texte):
+	correspondance = REGEX_DATE.fullmatch(texte)
+	if correspondance is None:
+		return None
+	jour, mois, annee = correspondance.groups()
+	try:
+		return dt(int(annee) + 2000 if len(annee) == 2 else int(annee), int(mois), int(jour)).strftime("%Y-%m-%d")
+	except ValueError:
+		return None
+
+# renvois l'heure 'HH:MM' d'un texte, None si ce n'est pas une heure valide
+@lru_cache(maxsize=1024)
+def lit_heure(texte):
+	correspondance = REGEX_HEURE.fullmatch(texte)
+	if correspondance is None:
+		return None
+	heure, minutes, minutes_h = correspondance.groups()
+	return f"{int(heure):02d}:{minutes or minutes_h or '00'}"
+
+# les modèles d'affichage d'une ligne de la base de donnée, préparés une seule fois
+# structure de la base de donnée
+#  - 0 : id
+#  - 1 : username
+#  - 2 : entreprise
+#  - 3 : date (remplacée par {date} sous la forme 'jeu. 12 mai')
+#  - 4 : lieu
+#  - 5 : heure début
+#  - 6 : heure fin
+MODELES_AFFICHAGE = {
+	# mode normal
+	"normal": " - ({2}) {date} à {4}, de {5} à {6}",
+	# mode récapitulatif
+	"recapitulatif": "({2}) {date} à {4}, de {5} à {6}",
+	# mode mail
+	"mail": "- {date} à {4}, de {5} à {6}",
+	# mode raccourci
+	"court": "{date} à {4}",
+	# mode affichant seulement la clef primaire
+	"id": "{0}",
+}
+# pour chaque mode, la fonction de mise en forme et si la date est affichée
+_MODELES = {mode: (modele.format, "{date}" in modele) for mode, modele in MODELES_AFFICHAGE.items()}
+
+# la date lisible d'une date de la base de donnée, gardée en mémoire car les memes dates reviennent souvent
+@lru_cache(maxsize=4096)
+def label_date(date):
+	return dt.fromisoformat(date).strftime("%a %-d %B")
+
+# renvois la fonction de mise en forme d'un mode d'affichage, erreur si le mode n'existe pas
+def _modele(mode):
+	try:
+		return _MODELES[mode]
+	except KeyError:
+		raise Exit(f"[!] mode inconnu d'affichage : {mode}")
+
 # renvois sous forme lisible une ligne de la base de donnée
 def bdd_to_string(extrait, mode="normal"):
-	# structure de la abse de donnée
-	#  - 0 : id
-	#  - 1 : username
-	#  - 2 : entreprise
-	#  - 3 : date
-	#  - 4 : lieu
-	#  - 5 : date début
-	#  - 6 : date fin
-
-	# si mode normal
-	if mode == "normal":
-		msg = " - ({}) {} à {}, de {} à {}".format(
-			extrait[2],
-			dt.strptime(extrait[3], "%Y/%m/%d").strftime("%a %-d %B"),
-			extrait[4],
-			extrait[5],
-			extrait[6])
-	# si mode récapitulatif
-	elif mode == "recapitulatif":
-		msg = "({}) {} à {}, de {} à {}".format(
-			extrait[2],
-			dt.strptime(extrait[3], "%Y/%m/%d").strftime("%a %-d %B"),
-			extrait[4],
-			extrait[5],
-			extrait[6])
-	# si mode mail
-	elif mode == "mail":
-		msg = "- {} à {}, de {} à {}".format(
-			dt.strptime(extrait[3], "%Y/%m/%d").strftime("%a %-d %B"),
-			extrait[4],
-			extrait[5],
-			extrait[6])
-	# si mode raccourci
-	elif mode == "court":
-		msg = "{} à {}".format(
-			dt.strptime(extrait[3], "%Y/%m/%d").strftime("%a %-d %B"),
-			extrait[4])
-	# si mode affichant seulement la clef primaire
-	elif mode == "id":
-		msg = extrait[0]
-
-	else:
-		print(f"[!] mode inconnu d'affichage : {mode}")
+	forme, avecDate = _modele(mode)
+	if avecDate:
+		return forme(*extrait, date=label_date(extrait[3]))
+	return forme(*extrait)
+
+# renvois sous forme lisible une liste de lignes de la base de donnée, en une seule passe
+def bdd_to_strings(extraits, mode="normal"):
+	forme, avecDate = _modele(mode)
+	if avecDate:
+		return [forme(*k, date=label_date(k[3])) for k in extraits]
+	return [forme(*k) for k in extraits]
+
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~	   TRAVAUX LENTS	   ~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+# exécute les travaux bloquants (réseau, fichiers) dans un pool de threads séparé de celui du dispatcher
+# un export lent n'occupe donc pas un thread qui pourrait répondre aux autres commandes
+class travaux_lents():
+	# création du pool de threads, maxTravaux limite le nombre de travaux uniques en cours ou en attente
+	def __init__(self, nom, nbThreads, maxTravaux=None):
+		self._executeur = ThreadPoolExecutor(max_workers=nbThreads, thread_name_prefix=nom)
+		self.maxTravaux = maxTravaux
+		self._lock = threading.Lock()
+		self._enCours = set()
+
+	# lance une fonction en arrière plan, ses erreurs sont transmises au gestionnaire d'erreurs du bot
+	def lance(self, dispatcher, update, fonction, *args):
+		futur = self._executeur.submit(fonction, *args)
+		futur.add_done_callback(lambda f: f.exception() is not None and dispatcher.dispatch_error(update, f.exception()))
+		return futur
+
+	# lance une fonction en arrière plan une seule fois par clef (un double appui ne crée qu'un seul travail)
+	# 'avant' est appelée une fois la place réservée, avant le lancement du travail
+	# renvois None si un travail avec cette clef est déja en cours ou si la file est pleine
+	def lance_unique(self, clef, dispatcher, update, fonction, *args, avant=None):
+		with self._lock:
+			if clef in self._enCours or (self.maxTravaux and len(self._enCours) >= self.maxTravaux):
+				return None
+			self._enCours.add(clef)
+		try:
+			if avant:
+				avant()
+			futur = self.lance(dispatcher, update, fonction, *args)
+		except Exception:
+			self._termine(clef)
+			raise
+		futur.add_done_callback(lambda f: self._termine(clef))
+		return futur
+
+	# renvois True si un travail avec cette clef est en cours ou en attente
+	def enCours(self, clef):
+		with self._lock:
+			return clef in self._enCours
+
+	# libère la clef d'un travail terminé
+	def _termine(self, clef):
+		with self._lock:
+			self._enCours.discard(clef)
+
+	# attend la fin des travaux en cours
+	def stop(self):
+		self._executeur.shutdown(wait=True)
+
+
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~	  ENVOI DES MAILS	   ~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+# envoit les mails de la file d'attente avec une session smtp authentifiée gardée ouverte entre les envois
+# la session est testée si elle n'a pas servi récemment, rouverte si elle est coupée et fermée après MAIL_INACTIVITE secondes sans mail
+class envoi_mails(threading.Thread):
+	# initialisation du thread, les réglages du serveur sont relus dans la configuration à chaque ouverture de session
+	def __init__(self, config):
+		super().__init__(name="mails", daemon=True)
+		self.config = config
+		self._file = queue.Queue()
+		self._serveur = None
+		self._reglages = None
+		self._derniere = 0
+
+	# ajoute un mail à la file d'attente, 'rappel(erreur)' est appelée après l'envoi (erreur vaut None si tout va bien)
+	def envoie(self, message, destinataire, rappel=None):
+		self._file.put((message, destinataire, rappel))
+
+	# envoit les mails encore en attente et arrete le thread
+	def stop(self):
+		self._file.put(None)
+		self.join()
+
+	# boucle principale : regroupe les mails en attente pour les envoyer dans la meme session
+	def run(self):
+		arret = False
+		while not arret:
+			try:
+				lot = [self._file.get(timeout=self.config.get().mail_inactivite)]
+			except queue.Empty:
+				self._ferme()
+				continue
+			while len(lot) < MAIL_LOT:
+				try:
+					lot.append(self._file.get_nowait())
+				except queue.Empty:
+					break
+			if None in lot:
+				arret = True
+				lot = [k for k in lot if k is not None]
+			for message, destinataire, rappel in lot:
+				debut = perf_counter()
+				erreur = self._envoie(message, destinataire)
+				METRIQUES.enregistre("smtp.envoi", perf_counter() - debut, erreur is not None)
+				if rappel:
+					try:
+						rappel(erreur)
+					except Exception as e:
+						LOG.warning("erreur dans le rappel d'un mail", extra={"donnees": {"erreur": repr(e)}})
+		self._ferme()
+
+	# envoit un mail, réessaie avec une attente croissante si la connection au serveur échoue
+	def _envoie(self, message, destinataire):
+		import smtplib
+		essais = self.config.get().mail_essais
+		for k in range(max(essais, 1)):
+			try:
+				serveur = self._session()
+				serveur.sendmail(self._reglages[2], destinataire, message.as_string())
+				self._derniere = monotonic()
+				return None
+			except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPHeloError, OSError) as e:
+				self._ferme()
+				erreur = e
+				if k < essais - 1:
+					sleep(2 ** k)
+			# erreur du serveur sur ce mail (destinataire refusé...), pas la peine de réessayer
+			except smtplib.SMTPException as e:
+				return e
+		return erreur
+
+	# renvois la session smtp ouverte, la crée si besoin
+	def _session(self):
+		import smtplib
+		config = self.config.get()
+		reglages = (config.server_name, config.server_port, config.mail_from, config.mail_mdp, config.mail_tls)
+		# réglages modifiés dans le .env
+		if self._serveur is not None and reglages != self._reglages:
+			self._ferme()
+		# session inutilisée depuis un moment, on vérifie qu'elle répond encore
+		if self._serveur is not None and monotonic() - self._derniere > MAIL_KEEPALIVE:
+			try:
+				if self._serveur.noop()[0] != 250:
+					self._ferme()
+			except (smtplib.SMTPException, OSError):
+				self._ferme()
+		if self._serveur is None:
+			serveur = smtplib.SMTP(config.server_name, config.server_port, timeout=30)
+			try:
+				serveur.ehlo()
+				if config.mail_tls:
+					serveur.starttls()
+					serveur.ehlo()
+				if serveur.has_extn("auth"):
+					serveur.login(config.mail_from, config.mail_mdp)
+			except Exception:
+				serveur.close()
+				raise
+			self._serveur = serveur
+			self._reglages = reglages
+			self._derniere = monotonic()
+		return self._serveur
+
+	# ferme la session smtp
+	def _ferme(self):
+		if self._serveur is not None:
+			import smtplib
+			try:
+				self._serveur.quit()
+			except (smtplib.SMTPException, OSError):
+				self._serveur.close()
+			self._serveur = None
+
+
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~	 ENVOI DES MESSAGES	   ~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+# un seau à jetons : 'debit' jetons par seconde, au plus 'capacite' jetons d'avance
+class seau_jetons():
+	# initialisation d'un seau plein
+	def __init__(self, debit, capacite):
+		self.debit = debit
+		self.capacite = capacite
+		self.jetons = capacite
+		self.date = monotonic()
+
+	# remplit le seau et renvois le temps d'attente avant le prochain jeton (0 si un jeton est disponible)
+	def attente(self, maintenant):
+		self.jetons = min(self.capacite, self.jetons + (maintenant - self.date) * self.debit)
+		self.date = maintenant
+		return 0 if self.jetons >= 1 else (1 - self.jetons) / self.debit
+
+	# prend un jeton
+	def prend(self):
+		self.jetons -= 1
+
+	# True si le seau s'est rempli depuis sa dernière utilisation
+	def plein(self, maintenant):
+		return self.jetons + (maintenant - self.date) * self.debit >= self.capacite
+
+# un envoi en attente : la méthode du bot à appeler, ses arguments, les futures des demandes regroupées dans cet envoi
+# et la clef de regroupement ('texte' pour un message simple, ('modifie', message_id) pour une modification)
+class envoi():
+	def __init__(self, fonction, args, kwargs, fusion):
+		self.fonction = fonction
+		self.args = args
+		self.kwargs = kwargs
+		self.fusion = fusion
+		self.futures = [Future()]
+		self.essais = 0
+
+# l'état d'une conversation : ses envois en attente, son seau à jetons, un envoi en cours et pause demandée par telegram
+class etat_chat():
+	def __init__(self):
+		self.file = deque()
+		self.seau = seau_jetons(ENVOIS_DEBIT_CHAT, ENVOIS_RAFALE_CHAT)
+		self.enCours = False
+		self.pasAvant = 0
+
+# la file des messages envoyés aux utilisateurs, vidée par quelques threads en respectant les limites de débit de telegram
+# (par conversation et global). les envois d'une conversation partent dans l'ordre, un seul à la fois ; les messages
+# simples consécutifs encore en attente sont regroupés en un seul, et une modification en attente d'un message est
+# remplacée par la suivante. si telegram demande d'attendre (erreur 429), la conversation est mise en pause et l'envoi réessayé.
+class envoi_messages():
+	# initialisation et lancement des threads d'envoi
+	def __init__(self, bot, nbThreads=ENVOIS_WORKERS, debitGlobal=ENVOIS_DEBIT_GLOBAL):
+		self.bot = bot
+		self._condition = threading.Condition()
+		self._chats = {}
+		self._global = seau_jetons(debitGlobal, max(1, debitGlobal))
+		self._arret = False
+		self._threads = [threading.Thread(target=self._boucle, name=f"envois_{k}", daemon=True) for k in range(nbThreads)]
+		for k in self._threads:
+			k.start()
+
+	# envoit un message, renvois une future du message envoyé
+	def message(self, chat_id, texte, **kwargs):
+		return self._ajoute(chat_id, envoi(self.bot.send_message, [chat_id, texte], kwargs, None if kwargs else "texte"))
+
+	# modifie le texte d'un message, renvois une future du message modifié
+	def modifie(self, chat_id, message_id, texte, **kwargs):
+		return self._ajoute(chat_id, envoi(self.bot.edit_message_text, [texte, chat_id, message_id], kwargs, ("modifie", message_id)))
+
+	# envoit un document, renvois une future du message envoyé
+	def document(self, chat_id, document, **kwargs):
+		return self._ajoute(chat_id, envoi(self.bot.send_document, [chat_id, document], kwargs, None))
+
+	# ajoute un envoi à la file de sa conversation, en le regroupant si possible avec le dernier envoi en attente
+	def _ajoute(self, chat_id, nouveau):
+		with self._condition:
+			etat = self._chats.get(chat_id)
+			if etat is None:
+				etat = self._chats[chat_id] = etat_chat()
+			dernier = etat.file[-1] if etat.file else None
+			if dernier is not None and nouveau.fusion is not None and dernier.fusion == nouveau.fusion:
+				# deux messages simples : textes mis bout à bout s'ils tiennent dans un message
+				if nouveau.fusion == "texte" and len(dernier.args[1]) + len(nouveau.args[1]) < 4096:
+					dernier.args[1] = f"{dernier.args[1]}\n{nouveau.args[1]}"
+					dernier.futures += nouveau.futures
+					METRIQUES.ajoute("telegram.regroupes")
+					return nouveau.futures[0]
+				# deux modifications du meme message : seule la dernière est envoyée
+				if nouveau.fusion != "texte":
+					nouveau.futures += dernier.futures
+					etat.file[-1] = nouveau
+					METRIQUES.ajoute("telegram.regroupes")
+					return nouveau.futures[0]
+			etat.file.append(nouveau)
+			self._condition.notify()
+		return nouveau.futures[0]
+
+	# attend le prochain envoi autorisé, None si la file est arretée et vide
+	def _suivant(self):
+		with self._condition:
+			while True:
+				maintenant = monotonic()
+				attente = None
+				for chat_id, etat in list(self._chats.items()):
+					if not etat.file:
+						# conversation inactive, oubliée une fois son seau rempli
+						if not etat.enCours and etat.seau.plein(maintenant):
+							del self._chats[chat_id]
+						continue
+					if etat.enCours:
+						continue
+					delai = max(etat.pasAvant - maintenant, etat.seau.attente(maintenant), self._global.attente(maintenant))
+					if delai <= 0:
+						etat.seau.prend()
+						self._global.prend()
+						etat.enCours = True
+						# la conversation passe en dernier pour le prochain tour
+						self._chats[chat_id] = self._chats.pop(chat_id)
+						return chat_id, etat, etat.file.popleft()
+					attente = delai if attente is None else min(attente, delai)
+				if self._arret and attente is None and not any(k.enCours for k in self._chats.values()):
+					self._condition.notify_all()
+					return None
+				self._condition.wait(attente)
+
+	# boucle des threads d'envoi
+	def _boucle(self):
+		while True:
+			suivant = self._suivant()
+			if suivant is None:
+				return
+			chat_id, etat, action = suivant
+			remise = self._envoie(etat, action)
+			with self._condition:
+				if remise:
+					etat.file.appendleft(action)
+				etat.enCours = False
+				self._condition.notify_all()
+
+	# fait un envoi, renvois True s'il faut le remettre en tete de la file de sa conversation
+	def _envoie(self, etat, action):
+		# les fichiers ont été lus par l'essai précédent, ils sont relus depuis le début
+		for k in list(action.args) + list(action.kwargs.values()):
+			if hasattr(k, "seek"):
+				k.seek(0)
+		debut = perf_counter()
+		try:
+			resultat = action.fonction(*action.args, **action.kwargs)
+		# telegram demande d'attendre avant d'envoyer dans cette conversation
+		except RetryAfter as e:
+			METRIQUES.ajoute("telegram.attente_s", e.retry_after)
+			LOG.warning("limite de débit de telegram", extra={"donnees": {"attente_s": e.retry_after}})
+			etat.pasAvant = monotonic() + e.retry_after
+			return True
+		# telegram ne répond pas, nouvel essai un peu plus tard
+		except (TimedOut, NetworkError) as e:
+			action.essais += 1
+			if action.essais < ENVOIS_ESSAIS:
+				etat.pasAvant = monotonic() + 2 ** action.essais
+				return True
+			self._termine(action, perf_counter() - debut, erreur=e)
+			return False
+		# le message modifié est identique, pas une erreur
+		except BadRequest as e:
+			if "not modified" in str(e):
+				self._termine(action, perf_counter() - debut, resultat=None)
+			else:
+				self._termine(action, perf_counter() - debut, erreur=e)
+			return False
+		except Exception as e:
+			self._termine(action, perf_counter() - debut, erreur=e)
+			return False
+		self._termine(action, perf_counter() - debut, resultat=resultat)
+		return False
+
+	# mesure l'envoi et donne son résultat (ou son erreur) aux demandes regroupées dedans
+	def _termine(self, action, duree, resultat=None, erreur=None):
+		METRIQUES.enregistre(f"telegram.{action.fonction.__name__}", duree, erreur is not None)
+		if erreur is not None:
+			LOG.warning("envoi telegram impossible", extra={"donnees": {"fonction": action.fonction.__name__, "erreur": repr(erreur)}})
+		for future in action.futures:
+			if erreur is None:
+				future.set_result(resultat)
+			else:
+				future.set_exception(erreur)
+
+	# envoit les messages encore en attente et arrete les threads
+	def stop(self, timeout=30):
+		with self._condition:
+			self._arret = True
+			self._condition.notify_all()
+		fin = monotonic() + timeout
+		for k in self._threads:
+			k.join(max(0, fin - monotonic()))
+
+# réponse à un message de l'utilisateur
+def repond(update, texte, **kwargs):
+	return ENVOIS.message(update.effective_chat.id, texte, **kwargs)
+
+# modification du message d'un clavier inline
+def modifie(query, texte, **kwargs):
+	return ENVOIS.modifie(query.message.chat_id, query.message.message_id, texte, **kwargs)
 
-	return msg
 
 ## ~~~~~~~~~~~~~~~~~~~~~~~~~~	   COMMANDES BOT	   ~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
 
 # fonction lancée par la commande '/start'
 def start(update, context):
-	update.message.reply_text("Coucou !\nAppuis sur '/' pour voir les commandes disponibles")
+	repond(update, "Coucou !\nAppuis sur '/' pour voir les commandes disponibles")
 
 # les fonctions de la conversations de nouvelle missions
 class conv_nouvelleMission():
 	# conversation de nouvelle mission, commande n°1 de lancement et demande de la date
 	def f_new_agence(update, context):
 		# le clavier qu'on va renvoyer
-		keyboard = [["adecco", "appel medical"]]
+		noms = AGENCES.noms()
+		keyboard = [noms[k:k+2] for k in range(0, len(noms), 2)]
 		# charge le clavier et l'envois
-		update.message.reply_text(
+		repond(update,
 			"Début de l'enregistrement d'une nouvelle mission\nentre '/stop' pour annuler à tout moment\n\n"
 			"Avec quelle agence était la mission ?",
 			reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
@@ -317,14 +1617,13 @@ class conv_nouvelleMission():
 
 	# conversation de nouvelle mission, commande n°1 de lancement et demande de la date
 	def f_agence_date(update, context):
-		global TO_SAVE
-		# enregistrement de l'agence
-		TO_SAVE.append(update.message.text)
+		# enregistrement de l'agence dans le brouillon de l'utilisateur
+		context.user_data[BROUILLON] = {"agence": update.message.text}
 		# le clavier qu'on va renvoyer
 		##keyboard = [["aujourd'hui", "autre"]]
 		# charge le clavier et l'envois
-		update.message.reply_text(
-			"ok, la date (en format 'JJ MM AAAA') de ta mission ?",
+		repond(update,
+			"ok, la date (en format 'JJ MM AAAA' ou 'JJ/MM/AAAA') de ta mission ?",
 			reply_markup=ReplyKeyboardRemove()
 			##reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
 		)
@@ -333,189 +1632,219 @@ class conv_nouvelleMission():
 
 	# conversation de nouvelle mission, commande n°2 pour enregistrer la date et demander le lieu
 	def f_date_lieu(update, context):
-		global TO_SAVE
 		# enregistrement de la date
-		TO_SAVE.append(dt.strptime(update.message.text, "%d %m %Y").strftime("%Y/%m/%d"))
+		context.user_data[BROUILLON]["date"] = context.date[0]
 		# la question suivante
-		update.message.reply_text("ok, maintenant le lieu ?")
+		repond(update, "ok, maintenant le lieu ?")
 		# renvoit l'étape suivante
 		return LIEU
 
 	# conversation de nouvelle mission, commande n°3 pour enregistrer le lieu et demander l'heure de début
 	def f_lieu_hDebut(update, context):
-		global TO_SAVE
 		# enregistrement du lieu
-		TO_SAVE.append(update.message.text)
+		context.user_data[BROUILLON]["lieu"] = update.message.text
 		# la question suivante
-		update.message.reply_text("l'heure réelle (en format 'HH MM') de début de mission ?")
+		repond(update, "l'heure réelle (en format 'HH MM' ou '8h30') de début de mission ?")
 		# renvoit l'étape suivante
 		return H_DEBUT
 
 	# conversation de nouvelle mission, commande n°4 pour enregistrer l'heure de début et demander l'heure de fin
 	def f_hDebut_hFin(update, context):
-		global TO_SAVE
 		# enregistrement de l'heure de début
-		TO_SAVE.append(dt.strptime(update.message.text, "%H %M").strftime("%H:%M"))
+		context.user_data[BROUILLON]["heure_debut"] = context.heure[0]
 		# la question suivante
-		update.message.reply_text("l'heure réelle (en format 'HH MM') de fin de mission ?")
+		repond(update, "l'heure réelle (en format 'HH MM' ou '8h30') de fin de mission ?")
 		# renvoit l'étape suivante
 		return H_FIN
 
 	# conversation de nouvelle mission, commande n°5 pour enregistrer l'heure de fin et clôturer
 	def f_hFin_sauvegarde(update, context):
-		global TO_SAVE
+		# récupération du brouillon de l'utilisateur (retiré des données utilisateur)
+		brouillon = context.user_data.pop(BROUILLON, {})
 		# enregistrement de l'heure de fin
-		TO_SAVE.append(dt.strptime(update.message.text, "%H %M").strftime("%H:%M"))
+		brouillon["heure_fin"] = context.heure[0]
 		# ajout d'un id unique et du nom d'utilisateur
-		TO_SAVE = [
-			md5(f"{TO_SAVE[0]}_{TO_SAVE[1]}_{update.effective_user.username}".encode()).hexdigest(),
+		to_save = [
+			md5(f"{brouillon['agence']}_{brouillon['date']}_{update.effective_user.username}".encode()).hexdigest(),
 			update.effective_user.username,
-		] + TO_SAVE
+			brouillon["agence"],
+			brouillon["date"],
+			brouillon["lieu"],
+			brouillon["heure_debut"],
+			brouillon["heure_fin"],
+		]
 		# un petit récapitulatif
-		update.message.reply_text(f"récapitulatif :\n{bdd_to_string(TO_SAVE, 'recapitulatif')}")
+		recapitulatif = bdd_to_string(to_save, "recapitulatif")
+		repond(update, f"récapitulatif :\n{recapitulatif}")
 		# sauvegarde de ces informations dans la base de donnée
 		try:
-			with obj_bdd(BDD_PATH, BDD_TABLE) as temp_bdd:
-				temp_bdd.create(TO_SAVE)
+			with POOL_BDD.borrow() as temp_bdd:
+				temp_bdd.create(to_save)
 			# réponse pour dire que tout va bien
-			update.message.reply_text("ok c'est bien enregistré")
-			print(f"created : {bdd_to_string(TO_SAVE, 'recapitulatif')}")
+			repond(update, "ok c'est bien enregistré")
+			LOG.info("mission enregistrée", extra={"donnees": {"username": update.effective_user.username, "mission": recapitulatif}})
 		except Exit as e:
 			# réponse pour dire qu'il y a eu une erreur
-			print("conversation create.f_hFin_sauvegarde", e) #update.message.reply_text(f"code d'erreur : {e}")
+			repond(update, "erreur, la mission n'a pas été enregistrée")
+			LOG.warning("enregistrement de la mission impossible", extra={"donnees": {"username": update.effective_user.username, "erreur": str(e)}})
 
-		# remise a zéro des constantes
-		TO_SAVE = []
 		# fin de la conversation
 		return ConversationHandler.END
 
 	# conversation de nouvelle mission, commande d'annulation '/stop'
 	def f_stop(update, context):
-		global TO_SAVE
-		# remise a zéro des constantes
-		TO_SAVE = []
+		# suppression du brouillon
+		context.user_data.pop(BROUILLON, None)
 		# message d'annulation
-		update.message.reply_text(
+		repond(update,
 			"annulation de l'enregistrement",
 			reply_markup=ReplyKeyboardRemove()
 		)
 		# fin de la conversation
 		return ConversationHandler.END
 
-# affiche les missions enregistrées dans la base de donnée
+# affiche les missions enregistrées dans la base de donnée, page par page
 def affiche_missions(update, context):
-	# toutes les données de la table et tri chronologique
-	with obj_bdd(BDD_PATH, BDD_TABLE) as temp_bdd:
-		temp = temp_bdd.getDatas(update.effective_user.username, "all")
+	# la première page, tri chronologique
+	with POOL_BDD.borrow() as temp_bdd:
+		page, encore = temp_bdd.getPage(update.effective_user.username, AFFICHAGE_PAGE)
 	# si la base de donnée n'est pas vide
-	if len(temp) > 0:
-		msg = "toutes les missions enregistrées :\n"
-		# pour chaque élément on ajoute une ligne
-		for k in temp:
-			msg += bdd_to_string(k) + "\n"
-		update.message.reply_text(msg[:-1])
+	if len(page) > 0:
+		texte, keyboard = page_missions(page, False, encore)
+		repond(update, texte, reply_markup=keyboard)
 	# sinon la bdd est vide
 	else:
-		update.message.reply_text("pas de mission enregistrées :(\nutilises la commande '/nouvelle_mission'")
-
-# supprime une mission de la base de données avec un clavier Inline
+		repond(update, "pas de mission enregistrées :(\nutilises la commande '/nouvelle_mission'")
+
+# le texte et le clavier de navigation d'une page de missions
+# les boutons contiennent la position (date, id) de la première ou dernière mission affichée : 'a_<_{date}_{id}' ou 'a_>_{date}_{id}'
+def page_missions(page, precedente, suivante):
+	lignes = [k if len(k) <= AFFICHAGE_LIGNE else f"{k[:AFFICHAGE_LIGNE-1]}…" for k in bdd_to_strings(page)]
+	texte = "toutes les missions enregistrées :\n" + "\n".join(lignes)
+	navigation = []
+	if precedente:
+		navigation.append(InlineKeyboardButton("< précédentes", callback_data=f"a_<_{page[0][3]}_{page[0][0]}"))
+	if suivante:
+		navigation.append(InlineKeyboardButton("suivantes >", callback_data=f"a_>_{page[-1][3]}_{page[-1][0]}"))
+	keyboard = InlineKeyboardMarkup([navigation]) if navigation else None
+	return texte, keyboard
+
+# supprime une mission de la base de données avec un clavier Inline, page par page
+# filtrable par mois et par agence : '/supprime_mission 05/2022 adecco'
 def supprime_mission(update, context):
-	# le clavuer inline qu'on va remplir
-	keyboard = []
-	# toutes les données de la table et tri chronologique
-	with obj_bdd(BDD_PATH, BDD_TABLE) as temp_bdd:
-		temp_datas = temp_bdd.getDatas(update.effective_user.username, "all")
-	# on les mets dans le lavier inline en colonne
-	for k in range(len(temp_datas)):
-		keyboard.append([InlineKeyboardButton(bdd_to_string(temp_datas[k], "court"), callback_data="s_"+bdd_to_string(temp_datas[k], "id"))])
-
+	mois, agence = None, None
+	for arg in " ".join(context.args or []).lower().split():
+		# un mois 'MM/AAAA' ou 'AAAA-MM'
+		if REGEX_MOIS.fullmatch(arg):
+			a, b = map(int, arg.replace("-", "/").split("/"))
+			annee, numero = (a, b) if a > 12 else (b, a)
+			mois = f"{annee:04d}-{numero:02d}"
+		# le reste est le nom de l'agence
+		else:
+			agence = f"{agence} {arg}" if agence else arg
+	if agence is not None and agence not in AGENCES.noms():
+		repond(update, f"agence inconnue, choisis parmi : {', '.join(AGENCES.noms())}")
+		return
+	if mois is not None and not 1 <= int(mois[5:]) <= 12:
+		repond(update, "mois invalide, utilises le format 'MM/AAAA'")
+		return
+	# la première page
+	texte, keyboard = page_suppression(update.effective_user.username, mois, agence)
+	repond(update, texte, reply_markup=keyboard)
+
+# le texte et le clavier d'une page de suppression
+# les boutons de navigation contiennent le sens, le filtre et la position : 's_>_{AAAAMM}_{n° agence}_{date}_{id}' (64 octets maximum)
+def page_suppression(username, mois, agence, apres=None, avant=None):
+	with POOL_BDD.borrow() as temp_bdd:
+		page, encore = temp_bdd.getPage(username, SUPPRESSION_PAGE, apres=apres, avant=avant, mois=mois, agence=agence)
+	filtre = ", ".join(k for k in (mois and dt.strptime(mois, "%Y-%m").strftime("%B %Y"), agence) if k)
+	texte = f"sélectionnes pour supprimer ({filtre}) :" if filtre else "sélectionnes pour supprimer :"
+	if len(page) == 0:
+		texte = "pas de mission à supprimer"
+	# une mission par ligne
+	keyboard = [[InlineKeyboardButton(texte_bouton, callback_data="s_"+clef)] for texte_bouton, clef in zip(bdd_to_strings(page, "court"), bdd_to_strings(page, "id"))]
+	# la ligne de navigation
+	position = f"{(mois or '').replace('-', '')}_{'' if agence is None else AGENCES.cherche(nom=agence).numero}"
+	precedente = encore if avant is not None else apres is not None
+	suivante = True if avant is not None else encore
+	navigation = []
+	if page and precedente:
+		navigation.append(InlineKeyboardButton("<", callback_data=f"s_<_{position}_{page[0][3]}_{page[0][0]}"))
+	if page and suivante:
+		navigation.append(InlineKeyboardButton(">", callback_data=f"s_>_{position}_{page[-1][3]}_{page[-1][0]}"))
+	if navigation:
+		keyboard.append(navigation)
 	# la ligne pour annuler
 	keyboard.append([InlineKeyboardButton("annuler", callback_data="s_annuler")])
-	# charge le clavier et l'envois
-	update.message.reply_text("sélectionnes pour supprimer :", reply_markup=InlineKeyboardMarkup(keyboard))
+	return texte, InlineKeyboardMarkup(keyboard)
 
 # envoit une capture d'écran des missions effectué pour donner les horaires exactes à l'agence
+# une section par agence ayant des missions, regroupées par destinataire : celui du registre des agences,
+# sinon celui du .env ('mail_to_{agence}'), sinon le destinataire par défaut
 def horaires_mail(update, context):
-	# récupère les constantes dans le .env
-	with open(os.path.join(BASEPATH, ".env"), "r") as f:
-		txt = f.read()
-	server_name = REGEX_SVR_NAME.findall(txt)[0][12:]
-	server_port = REGEX_SVR_PORT.findall(txt)[0][12:]
-	mail_from = REGEX_MAIL_FROM.findall(txt)[0][10:]
-	mail_mdp = REGEX_MAIL_MDP.findall(txt)[0][9:]
-	mail_to = REGEX_MAIL_TO.findall(txt)[0][8:]
-	del txt
+	# récupère les constantes du .env
+	config = CONFIG.get()
 	# toutes les données de la table et tri chronologique
-	with obj_bdd(BDD_PATH, BDD_TABLE) as temp_bdd:
+	with POOL_BDD.borrow() as temp_bdd:
 		temp = temp_bdd.getDatas(update.effective_user.username, "all")
-	# on crée les deux textes pour les deux agences
-	text_adecco = ""
-	text_appelMedical = ""
-	# répartition des mission de la base de donnée en fonction des agences
+	# répartition en un seul passage des missions en fonction des agences
+	groupes = defaultdict(list)
 	for k in temp:
-		if k[2] == "appel medical":
-			text_appelMedical += bdd_to_string(k, "mail") + "\n"
-		elif k[2] == "adecco":
-			text_adecco += bdd_to_string(k, "mail") + "\n"
-		else:
-			print(f"[!] agence inconnue : {k}")
-
-	# rédaction du message
-	message = MIMEMultipart("alternative")
-	message["Subject"] = "[INTERIM] horaires réelles de missions"
-	message["From"] = mail_from
-	message["To"] = mail_to
-
-	texte = f"""
-Missions avec Appel Medical :\n
+		groupes[k[2]].append(k)
+	if not groupes:
+		repond(update, "pas de mission enregistrées :(\nutilises la commande '/nouvelle_mission'")
+		return
+
+	# regroupement des sections par destinataire, dans l'ordre du registre des agences
+	sections = {}
+	for agence in AGENCES.sections(groupes):
+		destinataire = agence.mail_to or config.mail_agences.get(agence.nom, config.mail_to)
+		lignes = "".join(f"{k}\n" for k in bdd_to_strings(groupes[agence.nom], "mail"))
+		sections.setdefault(destinataire, []).append(f"""
+Missions avec {agence.titre} :\n
 Bonjour,\n
 veuillez trouver ci-joint les horaires réelles des missions que j'ai effectuée :\n
-{text_appelMedical}
-Cordialement,
-
--------------------------
-
-Missions avec adecco :\n
-Bonjour,\n
-veuillez trouver ci-joint les horaires réelles des missions que j'ai effectuée :\n
-{text_adecco}
-Cordialement,
+{lignes}
+Cordialement,""")
+
+	from email.mime.text import MIMEText
+	from email.mime.multipart import MIMEMultipart
+	for destinataire, textes in sections.items():
+		# rédaction du message
+		message = MIMEMultipart("alternative")
+		message["Subject"] = "[INTERIM] horaires réelles de missions"
+		message["From"] = config.mail_from
+		message["To"] = destinataire
+
+		texte = "\n\n-------------------------\n".join(textes) + f"""
 {update.effective_user.first_name}
 
 -------------------------
 bot TELEGRAM @missions_interim_bot
 by mgl corp."""
-	texte_mime = MIMEText(texte, "plain")
-	message.attach(texte_mime)
+		texte_mime = MIMEText(texte, "plain")
+		message.attach(texte_mime)
 
-	# connection au serveur
-	try:
-		with smtplib.SMTP(server_name, server_port) as server:
-			server.starttls()
-			server.login(mail_from, mail_mdp)
-			server.sendmail(mail_from, mail_to, message.as_string())
-
-		# réponse
-		update.message.reply_text("mail envoyé")
-	# si un problème
-	except Exception as e:
-		print("fonction horaire_mail", e)
-		update.message.reply_text(f"erreur dans l'envoi du mail :\n{e}")
-	finally:
-		del server_name
-		del server_port
-		del mail_from
-		del mail_mdp
-		del mail_to
+		# l'envoi est fait par le thread des mails, la réponse est donnée une fois le mail parti
+		MAILS.envoie(message, destinataire, lambda erreur, destinataire=destinataire: reponse_mail(update, destinataire, erreur))
+
+# réponse à l'utilisateur après l'envoi d'un mail
+def reponse_mail(update, destinataire, erreur):
+	if erreur is None:
+		repond(update, "mail envoyé")
+		LOG.info("mail envoyé", extra={"donnees": {"username": update.effective_user.username, "destinataire": destinataire}})
+	else:
+		LOG.warning("envoi du mail impossible", extra={"donnees": {"username": update.effective_user.username, "destinataire": destinataire, "erreur": repr(erreur)}})
+		repond(update, f"erreur dans l'envoi du mail :\n{erreur}")
 
 # exporte toutes les missions enregistrées dans un fichier excel
 def exporte_excel(update, context):
 	# nombre de lignes (toutes les données de la table)
-	with obj_bdd(BDD_PATH, BDD_TABLE) as temp_bdd:
-		nb_lignes = len(temp_bdd.getDatas(update.effective_user.username, "all"))
+	with POOL_BDD.borrow() as temp_bdd:
+		nb_lignes = temp_bdd.compte(update.effective_user.username)
 	# si la base de donnée est vide
 	if nb_lignes == 0:
-		update.message.reply_text("pas de mission enregistrées")
+		repond(update, "pas de mission enregistrées")
 	# sinon on envoit tout
 	else:
 		# le clavier Inline de confirmation de l'action
@@ -524,7 +1853,7 @@ def exporte_excel(update, context):
 			[InlineKeyboardButton("annuler", callback_data="e_annuler")]
 		]
 		# charge le clavier et l'envois
-		update.message.reply_text("veux-tu créer le fichier Excel ?\nAttention, il sera impossible ensuite d'envoyer le mail", reply_markup=InlineKeyboardMarkup(keyboard))
+		repond(update, "veux-tu créer le fichier Excel ?\nAttention, il sera impossible ensuite d'envoyer le mail", reply_markup=InlineKeyboardMarkup(keyboard))
 
 # fonction lancée par un appuis le clavier inline
 def button(update, context):
@@ -534,162 +1863,496 @@ def button(update, context):
 		query.answer()
 		if query.data[2:] == "annuler":
 			# réponse au client( change le message précédemment envoyé)
-			query.edit_message_text(text="annulé")
+			modifie(query, "annulé")
+		# navigation entre les pages : 's_<_...' ou 's_>_...'
+		elif query.data[2:3] in ("<", ">"):
+			sens, mois, agence, date, clef = query.data[2:].split("_", 4)
+			mois = f"{mois[:4]}-{mois[4:]}" if mois else None
+			agence = AGENCES.cherche(numero=int(agence)) if agence else None
+			agence = agence.nom if agence else None
+			position = {"avant" if sens == "<" else "apres": (date, clef)}
+			texte, keyboard = page_suppression(update.effective_user.username, mois, agence, **position)
+			modifie(query, texte, reply_markup=keyboard)
 		else:
 			try:
-				with obj_bdd(BDD_PATH, BDD_TABLE) as temp_bdd:
-					temp_bdd.delete(query.data[2:])
+				with POOL_BDD.borrow() as temp_bdd:
+					temp_bdd.delete(query.data[2:], update.effective_user.username)
 				# réponse au client (obligatoire sinon bug sur certains clients)
-				query.edit_message_text(text="mission supprimée")
-				print(f"deleted : {query.data[2:]}")
+				modifie(query, "mission supprimée")
+				LOG.info("mission supprimée", extra={"donnees": {"username": update.effective_user.username, "mission": query.data[2:]}})
 			except Exit as e:
 				# réponse pour dire qu'il y a eu une erreur
-				print("fonction button.supprime", e) #query.edit_message_text(text=f"code d'erreur : {e}")
+				LOG.warning("suppression de la mission impossible", extra={"donnees": {"username": update.effective_user.username, "erreur": str(e)}}) #modifie(query, f"code d'erreur : {e}")
+
+	# si la query commence par 'a', on change de page dans l'affichage des missions
+	elif query.data[:2] == "a_":
+		query.answer()
+		sens, date, clef = query.data[2:].split("_", 2)
+		with POOL_BDD.borrow() as temp_bdd:
+			if sens == "<":
+				page, encore = temp_bdd.getPage(update.effective_user.username, AFFICHAGE_PAGE, avant=(date, clef))
+				precedente, suivante = encore, True
+			else:
+				page, encore = temp_bdd.getPage(update.effective_user.username, AFFICHAGE_PAGE, apres=(date, clef))
+				precedente, suivante = True, encore
+		# si les missions ont été supprimées entre temps
+		if len(page) == 0:
+			modifie(query, "pas d'autres missions enregistrées")
+		else:
+			texte, keyboard = page_missions(page, precedente, suivante)
+			modifie(query, texte, reply_markup=keyboard)
 
 	# si la query commence par 'e', on exporte les missions
 	elif query.data[:2] == "e_":
-		query.answer()
 		# si c'est le code d'annulation
 		if query.data[2:] == "annuler":
+			query.answer()
 			# réponse au client( change le message précédemment envoyé)
-			query.edit_message_text(text="annulé")
+			modifie(query, "annulé")
 
-		# si c'est le code de continuation
+		# si c'est le code de continuation, l'export est mis dans la file des exports (un seul par utilisateur)
 		if query.data[2:] == "continuer":
-			# toutes les données de la table et tri chronologique
-			with obj_bdd(BDD_PATH, BDD_TABLE) as temp_bdd:
-				temp = temp_bdd.getDatas(update.effective_user.username, "all")
-			# on crée les deux listes pour les deux agences
-			list_adecco = []
-			list_appelMedical = []
-			# répartition des mission de la base de donnée en fonction des agences
-			for k in temp:
-				if k[2] == "appel medical":
-					list_appelMedical.append(k)
-				elif k[2] == "adecco":
-					list_adecco.append(k)
-				else:
-					print("[!] agence inconnue :", k)
-			# nombre de lignes qu'on va écrire
-			nb_lignes_appelMedical = len(list_appelMedical)
-			nb_lignes_adecco = len(list_adecco)
-			# création du fichier excel temporaire
-			wb = Workbook()
-			ws = wb.active
-			# missions de appel medical
-			i = -1
-			for row in ws.iter_rows(max_col=MAX_COL, min_row=0, max_row=nb_lignes_appelMedical):
-				if i == -1:
-					row[0].value = "appel medical"
-				else:
-					# mise en forme compréhensible par excel des données
-					row[0].value = dt.strptime(list_appelMedical[i][3], "%Y/%m/%d").strftime("%d/%m/%Y")
-					row[1].value = list_appelMedical[i][4]
-					row[4].value = list_appelMedical[i][5]
-					row[5].value = list_appelMedical[i][6]
-				i += 1
-			# mission de adecco
-			i = -1
-			for row in ws.iter_rows(max_col=MAX_COL, min_row=nb_lignes_appelMedical+3, max_row=nb_lignes_appelMedical+3+nb_lignes_adecco):
-				if i == -1:
-					row[0].value = "adecco"
+			# réponse au client avant le lancement de l'export
+			def attente():
+				query.answer()
+				modifie(query, "export en attente...")
+			if not EXPORTS.lance_unique(update.effective_user.id, context.dispatcher, update, creation_excel, update, context, avant=attente):
+				if EXPORTS.enCours(update.effective_user.id):
+					query.answer("un export est déjà en cours")
 				else:
-					# mise en forme compréhensible par excel des données
-					row[0].value = dt.strptime(list_adecco[i][3], "%Y/%m/%d").strftime("%d/%m/%Y")
-					row[1].value = list_adecco[i][4]
-					row[4].value = list_adecco[i][5]
-					row[5].value = list_adecco[i][6]
-				i += 1
-			# le chemin temporaire du excel
-			tempPathExcel = os.path.join(BASEPATH, "extrait.xlsx")
-			# sauvegarde du excel
-			wb.save(filename=tempPathExcel)
-			# envoit du fichier
-			query.edit_message_text("excel envoyé")
-			print("excel envoyé")
-			context.bot.send_document(chat_id=query.message.chat_id, document=open(tempPathExcel, "rb"))
-			# suppression du excel
-			os.remove(tempPathExcel)
-			# nettoyage de la base de données
-			try:
-				for k in temp:
-					with obj_bdd(BDD_PATH, BDD_TABLE) as temp_bdd:
-						temp_bdd.delete(k[0]) # la clef primaire est en position 0
-						print(f"deleted : {bdd_to_string(k, 'recapitulatif')}")
-				# envoi un nouveau message
-				context.bot.send_message(chat_id=query.message.chat_id, text="base de donnée nettoyée")
-			except Exit as e:
-				# réponse pour dire qu'il y a eu une erreur
-				print("fonction button.export", e) #context.bot.send_message(chat_id=query.message.chat_id, text=f"code d'erreur : {e}")
+					query.answer("trop d'exports en cours, réessaies dans quelques minutes", show_alert=True)
+
+# écrit en mémoire le fichier excel des missions d'un utilisateur, une section par agence dans l'ordre du registre séparées par une ligne vide
+# renvois le fichier et les clefs des missions exportées (pour le nettoyage de la base de donnée)
+# 'avancement' est appelée avec le nombre de missions écrites après chaque ligne
+def ecrit_excel(temp_bdd, username, avancement=None):
+	exportees = []
+	# création du excel en mode écriture seule : les lignes sont écrites directement depuis la base de donnée
+	from openpyxl import Workbook
+	wb = Workbook(write_only=True)
+	ws = wb.create_sheet()
+	agence = None
+	for k in temp_bdd.iterDatas(username):
+		if k[2] != agence:
+			if agence is not None:
+				ws.append([])
+			agence = k[2]
+			ws.append([agence])
+		# mise en forme compréhensible par excel des données (date 'AAAA-MM-JJ' en 'JJ/MM/AAAA')
+		ligne = [None] * MAX_COL
+		ligne[0] = f"{k[3][8:10]}/{k[3][5:7]}/{k[3][:4]}"
+		ligne[1] = k[4]
+		ligne[4] = k[5]
+		ligne[5] = k[6]
+		ws.append(ligne)
+		exportees.append(k[0]) # la clef primaire est en position 0
+		if avancement:
+			avancement(len(exportees))
+	# sauvegarde du excel en mémoire
+	fichier = BytesIO()
+	wb.save(fichier)
+	fichier.seek(0)
+	return fichier, exportees
+
+# crée et envoit le fichier excel puis nettoie la base de donnée, lancée en arrière plan par button
+def creation_excel(update, context):
+	query = update.callback_query
+	username = update.effective_user.username
+	modifie(query, "création du excel...")
+	# avancement, au plus un message toutes les EXPORT_PROGRESSION secondes
+	derniere = [monotonic()]
+	def avancement(nb):
+		if monotonic() - derniere[0] > EXPORT_PROGRESSION:
+			modifie(query, f"création du excel : {nb} missions...")
+			derniere[0] = monotonic()
+	with POOL_BDD.borrow() as temp_bdd, METRIQUES.mesure("export.excel"):
+		fichier, exportees = ecrit_excel(temp_bdd, username, avancement)
+	# les missions ont pu etre exportées par un appui précédent sur 'continuer', terminé entre temps
+	if not exportees:
+		modifie(query, "pas de mission enregistrées")
+		return
+	METRIQUES.ajoute("export.octets", fichier.getbuffer().nbytes)
+	METRIQUES.ajoute("export.missions", len(exportees))
+	# envoit du fichier, la base de donnée n'est nettoyée que si telegram a bien reçu le fichier
+	modifie(query, f"envoi du excel ({len(exportees)} missions)...")
+	try:
+		ENVOIS.document(query.message.chat_id, fichier, filename="extrait.xlsx").result()
+	except TelegramError as e:
+		modifie(query, "erreur dans l'envoi du excel, les missions sont conservées")
+		LOG.warning("envoi du excel impossible", extra={"donnees": {"username": username, "erreur": repr(e)}})
+		return
+	LOG.info("excel envoyé", extra={"donnees": {"username": username, "missions": len(exportees)}})
+	# nettoyage de la base de données, les missions exportées sont supprimées en une seule transaction
+	try:
+		with POOL_BDD.borrow() as temp_bdd:
+			nb = temp_bdd.purge(username, exportees)
+		LOG.info("missions exportées supprimées", extra={"donnees": {"username": username, "missions": nb}})
+		# un seul message de fin pour l'envoi et le nettoyage
+		modifie(query, f"excel envoyé\nbase de donnée nettoyée ({nb} missions supprimées)")
+	except Exit as e:
+		# réponse pour dire qu'il y a eu une erreur
+		modifie(query, "excel envoyé")
+		LOG.warning("nettoyage après export impossible", extra={"donnees": {"username": username, "erreur": str(e)}}) #modifie(query, f"code d'erreur : {e}")
 
 # affiche l'aide
 def help(update, context):
-	update.message.reply_text("""\
+	repond(update, """\
 Commandes disponibles:
 /nouvelle_mission : enregistre une nouvelle mission
 /affiche_missions : affiche toutes les missions
-/supprime_mission : supprime une mission
+/supprime_mission [MM/AAAA] [agence] : supprime une mission
 /horaires_mail : envoie par mail les horaires réels pour l'agence
 /exporte_excel : renvoit le fichier excel rempli
 /help : affiche l'aide""")
 
 # affiche les erreurs rencontrés par le programme
 def error(update, context):
-	print(f"Update '{update}' \ncaused error '{context.error}'")
+	# les erreurs des jobs et des tâches internes n'ont pas de mise à jour telegram
+	donnees = update.to_dict() if isinstance(update, Update) else repr(update)
+	LOG.error("erreur d'un handler", exc_info=context.error, extra={"donnees": {"update": donnees}})
+
+# affiche les mesures du bot, réservé aux administrateurs du .env
+def stats(update, context):
+	config = CONFIG.get()
+	utilisateur = update.effective_user
+	if str(utilisateur.id) not in config.admins and (utilisateur.username or "").lower() not in config.admins:
+		repond(update, "commande réservée aux administrateurs")
+		return
+	resume = METRIQUES.resume()
+	lignes = [f"mesures depuis {resume['duree_s'] // 60} minutes (nombre, erreurs, p50/p95/p99 en ms) :"]
+	# en mode superviseur, chaque processus a ses propres mesures
+	if PROCESSUS_NUMERO is not None:
+		lignes[0] = f"processus {PROCESSUS_NUMERO}, {lignes[0]}"
+	for nom, k in resume["durees"].items():
+		lignes.append(f"{nom} : {k['nombre']}, {k['erreurs']}, {k['p50_ms']}/{k['p95_ms']}/{k['p99_ms']}")
+	for nom, k in resume["valeurs"].items():
+		lignes.append(f"{nom} : {k['somme']} ({k['nombre']} fois)")
+	texte = "\n".join(lignes)
+	# un message telegram fait au plus 4096 caractères
+	if len(texte) > 4096:
+		texte = texte[:4095] + "…"
+	repond(update, texte)
+
+
+# écriture périodique des conversations en cours, lancée par la job queue du bot
+def sauvegarde_persistance(context):
+	context.dispatcher.persistence.flush()
+
+# maintenance périodique de la base de donnée, lancée par la job queue du bot
+def maintenance_bdd(context):
+	with POOL_BDD.borrow() as temp_bdd:
+		resultat = temp_bdd.maintenance()
+	LOG.info("maintenance de la base de donnée", extra={"donnees": {"resultat": resultat}})
+
+# écriture périodique des mesures dans les journaux
+def journal_mesures(context):
+	LOG.info("mesures", extra={"donnees": METRIQUES.resume()})
+
+
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~	  MODE SUPERVISEUR	   ~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+# un processus du mode superviseur : traite les mises à jour transmises par le superviseur dans 'file'
+# et donne signe de vie dans 'signe' (date de la dernière tâche de signe de vie exécutée par un thread du dispatcher)
+def processus_bot(numero, nombre, file, signe):
+	global CONFIG, PROCESSUS_NUMERO, ENVOIS
+	PROCESSUS_NUMERO = numero
+	# les signaux d'arret sont gérés par le superviseur, qui arrete les processus par leur file
+	signal(SIGINT, SIG_IGN)
+	signal(SIGTERM, SIG_IGN)
+	superviseur_pid = os.getppid()
+	setlocale(LC_ALL, 'fr_FR.utf8')
+	initialise_journaux(numero)
+	CONFIG = configuration(os.path.join(BASEPATH, ".env"))
+	config = CONFIG.get()
+	initialise_services(config)
+	# le dispatcher du processus, sans récupération des mises à jour (faite par le superviseur)
+	bot = Bot(config.token, request=Request(con_pool_size=config.bot_workers + ENVOIS_WORKERS + 4))
+	job_queue = JobQueue()
+	dispatcher = Dispatcher(bot, queue.Queue(), workers=config.bot_workers, persistence=persistance_bdd(POOL_BDD), job_queue=job_queue)
+	job_queue.set_dispatcher(dispatcher)
+	# la limite globale de telegram est partagée entre les processus
+	ENVOIS = envoi_messages(bot, debitGlobal=ENVOIS_DEBIT_GLOBAL / nombre)
+	# chaque processus écrit ses conversations en cours, seulement celles de ses utilisateurs
+	job_queue.run_repeating(METRIQUES.instrumente("job.sauvegarde_persistance", sauvegarde_persistance), interval=config.persistance_intervalle, first=config.persistance_intervalle)
+	if config.metriques_intervalle:
+		job_queue.run_repeating(journal_mesures, interval=config.metriques_intervalle, first=config.metriques_intervalle)
+	ajoute_handlers(dispatcher)
+	# signe de vie : un job vérifie que le dispatcher tourne et fait exécuter une tâche par un de ses threads,
+	# un processus dont le dispatcher ou les threads sont bloqués n'en donne plus et est relancé par le superviseur
+	# (la tâche porte une mise à jour vide, sinon telegram compare ensuite les données de tous les utilisateurs chargés)
+	def envoie_signe(context):
+		if dispatcher.running:
+			dispatcher.run_async(recoit_signe, update=Update(0))
+	def recoit_signe():
+		signe.value = time()
+	job_queue.run_repeating(envoie_signe, interval=PROCESSUS_SURVEILLANCE, first=0)
+	# les mesures du processus n°k sont servies sur le port suivant celui du superviseur
+	serveur = serveur_mesures(config.metriques_listen, config.metriques_port + 1 + numero) if config.metriques_port else None
+	job_queue.start()
+	travail = threading.Thread(target=dispatcher.start, name=f"dispatcher_{numero}", daemon=True)
+	travail.start()
+	LOG.info("processus lancé", extra={"donnees": {"pid": os.getpid()}})
+
+	# transmet les mises à jour au dispatcher jusqu'à la demande d'arret (None), l'arret du dispatcher ou celui du superviseur
+	arret = False
+	while travail.is_alive() and os.getppid() == superviseur_pid:
+		try:
+			donnees = file.get(timeout=1)
+		except queue.Empty:
+			continue
+		if donnees is None:
+			arret = True
+			break
+		dispatcher.update_queue.put(Update.de_json(donnees, bot))
+	# fin des commandes en cours, écriture des conversations puis fermeture comme le processus unique
+	job_queue.stop()
+	dispatcher.stop()
+	dispatcher.update_persistence()
+	dispatcher.persistence.flush()
+	MAILS.stop()
+	EXPORTS.stop()
+	ENVOIS.stop()
+	POOL_BDD.close()
+	if serveur is not None:
+		serveur.shutdown()
+	# un arret non demandé est signalé au superviseur, qui relance le processus
+	sys.exit(0 if arret else 1)
+
+# le superviseur : répartit les mises à jour entre 'nombre' processus selon l'utilisateur, et relance les processus arretés ou bloqués
+# un utilisateur est toujours traité par le meme processus, qui garde l'ordre de ses messages et l'état de ses conversations
+class superviseur():
+	# lancement des processus
+	def __init__(self, nombre):
+		# les processus sont lancés (et relancés) sans copier les threads du superviseur
+		self._contexte = multiprocessing.get_context("spawn")
+		self.nombre = nombre
+		self._lock = threading.Lock()
+		self._arret = False
+		self._processus = [None] * nombre
+		self._files = [None] * nombre
+		self._signes = [self._contexte.Value("d", 0.0, lock=False) for k in range(nombre)]
+		for k in range(nombre):
+			self._lance(k)
+
+	# lance le processus n°numero, avec une nouvelle file si l'ancienne est absente ou a pu etre abimée
+	# (un processus tué pendant la lecture de sa file garde le verrou de la file)
+	def _lance(self, numero, nouvelleFile=True):
+		if nouvelleFile:
+			self._files[numero] = self._contexte.Queue()
+		self._signes[numero].value = time()
+		self._processus[numero] = self._contexte.Process(
+			target=processus_bot,
+			args=(numero, self.nombre, self._files[numero], self._signes[numero]),
+			name=f"interimBot_{numero}",
+		)
+		self._processus[numero].start()
+
+	# le numéro du processus d'une mise à jour : l'identifiant telegram de l'utilisateur (ou du chat) modulo le nombre de processus
+	def numero(self, update):
+		utilisateur = update.effective_user or update.effective_chat
+		return utilisateur.id % self.nombre if utilisateur else 0
+
+	# callback du dispatcher du superviseur, transmet la mise à jour au processus de l'utilisateur
+	# (avec le verrou : pendant une relance, la mise à jour attend la nouvelle file au lieu d'etre perdue dans l'ancienne)
+	def transmet(self, update, context):
+		donnees = update.to_dict()
+		with self._lock:
+			self._files[self.numero(update)].put(donnees)
+		METRIQUES.ajoute("superviseur.transmises")
+
+	# job périodique : relance les processus arretés et ceux qui ne donnent plus signe de vie
+	# la file est gardée, avec les mises à jour en attente, seulement si le processus s'est arreté de lui-meme
+	def surveille(self, context=None):
+		with self._lock:
+			if self._arret:
+				return
+			for k, processus in enumerate(self._processus):
+				if not processus.is_alive():
+					LOG.warning("processus arreté, relance", extra={"donnees": {"processus": k, "code": processus.exitcode}})
+					self._lance(k, nouvelleFile=processus.exitcode < 0)
+				elif time() - self._signes[k].value > PROCESSUS_SILENCE:
+					LOG.warning("processus sans signe de vie, relance", extra={"donnees": {"processus": k, "silence_s": PROCESSUS_SILENCE}})
+					processus.kill()
+					processus.join()
+					self._lance(k)
+				else:
+					continue
+				METRIQUES.ajoute("superviseur.relances")
+
+	# arrete les processus une fois traitées les mises à jour déja transmises
+	def stop(self, timeout=30):
+		with self._lock:
+			self._arret = True
+		for file in self._files:
+			file.put(None)
+		for processus in self._processus:
+			processus.join(timeout)
+			# les processus ignorent SIGTERM, ils sont tués s'ils ne s'arretent pas à temps
+			if processus.is_alive():
+				processus.kill()
+				processus.join()
 
 
 ## ~~~~~~~~~~~~~~~~~~~~~~~~~~	FONCTION PRINCIPALE	~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
 
-# la fonction principale du bot
-def main():
-	# récupere le token d'identitification dans le .env
-	if os.path.isfile(os.path.join(BASEPATH, ".env")):
-		with open(os.path.join(BASEPATH, ".env"), "r") as f:
-			try:
-				# création du bot avec son token d'authentification (retire le 'token=' du début)
-				bot = Updater(REGEX_TOKEN.findall(f.read())[0][6:], use_context=True)
-			except Exception as e:
-				raise e
-	else:
-		raise Exit("[!] le fichier .env contenant le token d'identitification n'existe pas")
-	# initialisation de la base de donnée (crée la base de donnée et la table si elle n'existe pas)
-	DATABASE = obj_bdd(BDD_PATH, BDD_TABLE)
+# journaux au format json sur la sortie d'erreur, sans le détail de chaque lancement des tâches périodiques
+def initialise_journaux(processus=None):
+	journal = logging.StreamHandler()
+	journal.setFormatter(format_json(processus))
+	logging.basicConfig(level=logging.INFO, handlers=[journal])
+	logging.getLogger("apscheduler").setLevel(logging.WARNING)
+
+# initialisation de la base de donnée (crée la base de donnée et la table si elle n'existe pas), du registre des agences,
+# de l'envoi des mails et des exports excel
+def initialise_services(config):
+	global POOL_BDD, AGENCES, MAILS, EXPORTS
+	# en mode superviseur la base de donnée est partagée entre les processus, ce qui demande le journal WAL
+	pragmas = dict(config.sqlite)
+	if config.processus > 1:
+		pragmas["journal_mode"] = "WAL"
+	POOL_BDD = pool_bdd(BDD_PATH, BDD_TABLE, pragmas)
+	# le registre des agences
+	AGENCES = registre_agences(POOL_BDD)
+	# lancement du thread d'envoi des mails
+	MAILS = envoi_mails(CONFIG)
+	MAILS.start()
+	# initialisation de la file des exports excel, séparée pour ne pas bloquer l'envoi des mails
+	EXPORTS = travaux_lents("export", config.export_workers, config.export_attente)
+
+# ajout des gestionnaires de commande et d'erreur au dispatcher
+def ajoute_handlers(dispatcher):
 	# création du conversation handler pour créer un nouvel enregistrement
 	conversation_nouvelleMission = ConversationHandler(
-		entry_points=[CommandHandler("nouvelle_mission", conv_nouvelleMission.f_new_agence)],
+		entry_points=[CommandHandler("nouvelle_mission", conv_nouvelleMission.f_new_agence, run_async=True)],
 		states={
-			AGENCE: [MessageHandler(filtres_perso.agence, conv_nouvelleMission.f_agence_date)],
-			DATE: [MessageHandler(filtres_perso.date, conv_nouvelleMission.f_date_lieu)],
-			LIEU: [MessageHandler(Filters.text & ~Filters.command, conv_nouvelleMission.f_lieu_hDebut)],
-			H_DEBUT: [MessageHandler(filtres_perso.heure, conv_nouvelleMission.f_hDebut_hFin)],
-			H_FIN: [MessageHandler(filtres_perso.heure, conv_nouvelleMission.f_hFin_sauvegarde)],
+			AGENCE: [MessageHandler(filtres_perso.agence, conv_nouvelleMission.f_agence_date, run_async=True)],
+			DATE: [MessageHandler(filtres_perso.date, conv_nouvelleMission.f_date_lieu, run_async=True)],
+			LIEU: [MessageHandler(Filters.text & ~Filters.command, conv_nouvelleMission.f_lieu_hDebut, run_async=True)],
+			H_DEBUT: [MessageHandler(filtres_perso.heure, conv_nouvelleMission.f_hDebut_hFin, run_async=True)],
+			H_FIN: [MessageHandler(filtres_perso.heure, conv_nouvelleMission.f_hFin_sauvegarde, run_async=True)],
 		},
-		fallbacks=[CommandHandler("stop", conv_nouvelleMission.f_stop)],
+		fallbacks=[CommandHandler("stop", conv_nouvelleMission.f_stop, run_async=True)],
+		name="nouvelle_mission",
+		persistent=True,
 	)
 	# ajout des gestionnaires de commande par ordre d'importance
+	# ils sont lancés en parallèle dans les threads du dispatcher (chaque utilisateur a son propre brouillon et sa connection à la bdd)
 	# la commande /start
-	bot.dispatcher.add_handler(CommandHandler("start", start))
+	dispatcher.add_handler(CommandHandler("start", start, run_async=True))
 	# la commande de conversation /nouvelle_mission
-	bot.dispatcher.add_handler(conversation_nouvelleMission)
+	dispatcher.add_handler(conversation_nouvelleMission)
 	# la commande /affiche_missions
-	bot.dispatcher.add_handler(CommandHandler("affiche_missions", affiche_missions))
+	dispatcher.add_handler(CommandHandler("affiche_missions", affiche_missions, run_async=True))
 	# la commande /supprime_mission
-	bot.dispatcher.add_handler(CommandHandler("supprime_mission", supprime_mission))
+	dispatcher.add_handler(CommandHandler("supprime_mission", supprime_mission, run_async=True))
 	# la commande /horaires_mail
-	bot.dispatcher.add_handler(CommandHandler("horaires_mail", horaires_mail))
+	dispatcher.add_handler(CommandHandler("horaires_mail", horaires_mail, run_async=True))
 	# la commande /exporte_excel
-	bot.dispatcher.add_handler(CommandHandler("exporte_excel", exporte_excel))
+	dispatcher.add_handler(CommandHandler("exporte_excel", exporte_excel, run_async=True))
 	# le clavier inline
-	bot.dispatcher.add_handler(CallbackQueryHandler(button))
+	dispatcher.add_handler(CallbackQueryHandler(button, run_async=True))
 	# la commande /help
-	bot.dispatcher.add_handler(CommandHandler("help", help))
+	dispatcher.add_handler(CommandHandler("help", help, run_async=True))
+	# la commande /stats des administrateurs
+	dispatcher.add_handler(CommandHandler("stats", stats, run_async=True))
+	# mesure de tous les handlers
+	instrumente_handlers(dispatcher)
 	# gestion des erreurs
+	dispatcher.add_error_handler(error)
+
+# lance la récupération des mises à jour, en mode webhook si une URL publique est configurée, sinon en long polling
+def demarre(bot, config):
+	webhook = config.webhook
+	if webhook["url"]:
+		url_path = "/".join(k for k in (webhook["path"], webhook["secret"]) if k)
+		bot.start_webhook(
+			listen=webhook["listen"],
+			port=int(webhook["port"]),
+			url_path=url_path,
+			webhook_url=f"{webhook['url'].rstrip('/')}/{url_path}",
+		)
+		LOG.info("webhook en écoute", extra={"donnees": {"listen": webhook["listen"], "port": webhook["port"]}})
+	else:
+		bot.start_polling()
+
+# le mode superviseur : le processus principal récupère les mises à jour et les répartit entre les processus du bot
+def main_superviseur(config):
+	global POOL_BDD
+	# la base de donnée est créée et migrée une seule fois avant le lancement des processus, qui la partagent en mode WAL
+	POOL_BDD = pool_bdd(BDD_PATH, BDD_TABLE, dict(config.sqlite, journal_mode="WAL"))
+	processus = superviseur(config.processus)
+	bot = Updater(config.token, use_context=True, workers=1)
+	bot.dispatcher.add_handler(TypeHandler(Update, processus.transmet))
 	bot.dispatcher.add_error_handler(error)
+	# la maintenance de la base de donnée est faite par le superviseur seulement
+	bot.job_queue.run_repeating(METRIQUES.instrumente("job.maintenance_bdd", maintenance_bdd), interval=config.sqlite_maintenance, first=config.sqlite_maintenance)
+	# surveillance des processus
+	bot.job_queue.run_repeating(processus.surveille, interval=PROCESSUS_SURVEILLANCE, first=PROCESSUS_SURVEILLANCE)
+	# les mesures du superviseur (mises à jour transmises, relances) sur le port configuré, celles des processus sur les ports suivants
+	serveur = serveur_mesures(config.metriques_listen, config.metriques_port) if config.metriques_port else None
+	LOG.info("superviseur lancé", extra={"donnees": {"processus": config.processus}})
+	demarre(bot, config)
+	# continue le programme jusqu'à la reception d'un signal de fin (par ex: CTRL-C)
+	bot.idle()
+	# les processus terminent les mises à jour déja transmises avant de s'arreter
+	processus.stop()
+	POOL_BDD.close()
+	if serveur is not None:
+		serveur.shutdown()
 
-	# lance le bot
-	bot.start_polling()
+# la fonction principale du bot
+def main():
+	global CONFIG, ENVOIS
+	# mise du programme en français pour les affichage de strftime
+	setlocale(LC_ALL, 'fr_FR.utf8')
+	initialise_journaux()
+	# récupere le token d'identitification et les réglages du bot et de sqlite dans le .env
+	CONFIG = configuration(os.path.join(BASEPATH, ".env"))
+	config = CONFIG.get()
+	# plusieurs processus pour utiliser tous les coeurs du serveur
+	if config.processus > 1:
+		main_superviseur(config)
+		return
+	initialise_services(config)
+	try:
+		# création du bot avec son token d'authentification
+		# les conversations en cours sont rechargées depuis la base de donnée
+		# les connections http sont partagées entre les threads du dispatcher et ceux de la file des messages
+		bot = Updater(
+			config.token,
+			use_context=True,
+			workers=config.bot_workers,
+			persistence=persistance_bdd(POOL_BDD),
+			request_kwargs={"con_pool_size": config.bot_workers + ENVOIS_WORKERS + 4},
+		)
+	except Exception as e:
+		raise e
+	# la file des messages envoyés aux utilisateurs
+	ENVOIS = envoi_messages(bot.bot)
+	# maintenance périodique de la base de donnée (checkpoint du journal WAL et optimisation)
+	bot.job_queue.run_repeating(METRIQUES.instrumente("job.maintenance_bdd", maintenance_bdd), interval=config.sqlite_maintenance, first=config.sqlite_maintenance)
+	# écriture périodique des conversations en cours
+	bot.job_queue.run_repeating(METRIQUES.instrumente("job.sauvegarde_persistance", sauvegarde_persistance), interval=config.persistance_intervalle, first=config.persistance_intervalle)
+	# écriture périodique des mesures dans les journaux
+	if config.metriques_intervalle:
+		bot.job_queue.run_repeating(journal_mesures, interval=config.metriques_intervalle, first=config.metriques_intervalle)
+	ajoute_handlers(bot.dispatcher)
+	# serveur http optionnel des mesures au format prometheus
+	serveur = serveur_mesures(config.metriques_listen, config.metriques_port) if config.metriques_port else None
+
+	demarre(bot, config)
 	# continue le programme jusqu'à la reception d'un signal de fin (par ex: CTRL-C)
 	bot.idle()
+	# telegram écrit les conversations avant l'arret du dispatcher : les handlers terminés depuis sont écrits ici
+	bot.dispatcher.update_persistence()
+	bot.dispatcher.persistence.flush()
+	# fin des envois et des exports en cours et fermeture des connections à la base de donnée
+	MAILS.stop()
+	EXPORTS.stop()
+	ENVOIS.stop()
+	POOL_BDD.close()
+	if serveur is not None:
+		serveur.shutdown()
 
 # lance la fonction principale
 if __name__ == "__main__":
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+##																				   ##
+##  ----  ----  ----	   MESURES DE PERFORMANCE D'INTERIMBOT		 ----  ----  ----  ##
+##																				   ##
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+## programme pour mesurer les performances du bot, les résultats sont écrits au format json
+## pour pouvoir comparer les mesures entre deux versions sur la meme machine.
+##   python3 interimBot_bench.py demarrage [--repete N] [--reference mesures.json] [--tolerance 0.2] [--sortie mesures.json]
+##   python3 interimBot_bench.py bdd [--utilisateurs U] [--missions M ...] [--repete N] [--reference ...] [--sortie ...]
+## 'demarrage' mesure le temps d'import de interimBot.py avec 'python -X importtime' et vérifie que les
+## modules chargés à la première utilisation (openpyxl, smtplib, email.mime) ne le sont pas au démarrage.
+## 'bdd' génère des bases de donnée synthétiques (U utilisateurs ayant chacun M missions) et mesure les
+## opérations de obj_bdd, la mise en forme des missions et la création du fichier excel pour un utilisateur.
+## avec une référence, le programme s'arrete en erreur si une mesure est plus lente que la tolérance.
+
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~		PARAMETRES		 ~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+# modules complémentaires
+import os
+import sys
+import json
+import shutil
+import platform
+import subprocess
+import tempfile
+from random import Random
+from argparse import ArgumentParser
+from re import compile as reCompile
+from statistics import median
+from time import perf_counter
+
+# dossier du bot
+BASEPATH = os.path.realpath(os.path.dirname(sys.argv[0]))
+# une ligne de 'python -X importtime' : durée propre, durée cumulée (en µs), indentation et nom du module
+REGEX_IMPORTTIME = reCompile(r"import time:\s+([0-9]+) \|\s+([0-9]+) \|( *)(\S+)")
+# modules qui ne doivent pas etre chargés au démarrage du bot
+MODULES_PARESSEUX = ["openpyxl", "smtplib", "email.mime"]
+# nombre de modules les plus lents affichés
+NB_MODULES = 10
+# graine des données synthétiques, pour avoir les memes bases de donnée d'une mesure à l'autre
+GRAINE = 2022
+# nombre de missions insérées par requète lors de la génération
+LOT = 10000
+# écart minimum en millisecondes pour signaler un ralentissement (les mesures très courtes sont bruitées)
+ECART_MINIMUM = 0.5
+
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~		 FONCTIONS		 ~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+# minimum, médiane et maximum d'une liste de durées, en millisecondes
+def resume(durees):
+	return {"min": round(min(durees), 3), "mediane": round(median(durees), 3), "max": round(max(durees), 3)}
+
+# la version du code mesurée, si le dossier est un dépot git
+def version_git():
+	try:
+		return subprocess.run(["git", "-C", BASEPATH, "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+# importe le bot dans un nouveau processus, renvois la durée totale (ms) et les lignes de 'python -X importtime'
+def import_bot():
+	debut = perf_counter()
+	resultat = subprocess.run([sys.executable, "-X", "importtime", "-c", "import interimBot"], cwd=BASEPATH, capture_output=True, text=True)
+	duree = (perf_counter() - debut) * 1000
+	if resultat.returncode != 0:
+		print(f"[!] import de interimBot impossible :\n{resultat.stderr[-2000:]}")
+		sys.exit(1)
+	return duree, REGEX_IMPORTTIME.findall(resultat.stderr)
+
+# mesure du démarrage, renvois les mesures et la liste des problèmes trouvés
+def mesure_demarrage(repete):
+	totaux, imports, cumuls, problemes = [], [], {}, []
+	for k in range(repete):
+		duree, lignes = import_bot()
+		totaux.append(duree)
+		# les modules importés directement par le bot sont affichés juste avant lui, avec un niveau d'indentation de plus
+		enfants = []
+		for propre, cumul, indentation, module in lignes:
+			if len(indentation) == 3:
+				enfants.append((module, int(cumul) / 1000))
+			elif len(indentation) == 1:
+				if module == "interimBot":
+					imports.append(int(cumul) / 1000)
+					for enfant, duree in enfants:
+						cumuls.setdefault(enfant, []).append(duree)
+				enfants = []
+		# modules chargés trop tot
+		if k == 0:
+			charges = {k[3] for k in lignes}
+			for module in MODULES_PARESSEUX:
+				if any(k == module or k.startswith(f"{module}.") for k in charges):
+					problemes.append(f"module '{module}' chargé au démarrage")
+	lents = sorted(((median(v), k) for k, v in cumuls.items()), reverse=True)[:NB_MODULES]
+	mesures = {
+		"demarrage_ms": resume(totaux),
+		"import_interimBot_ms": resume(imports),
+		"modules_lents_ms": {k: round(v, 3) for v, k in lents},
+	}
+	return mesures, problemes
+
+# durées en millisecondes de 'repete' appels à 'fonction', 'preparation' est appelée avant chaque appel sans etre mesurée
+# et son résultat est passé à 'fonction'
+def chrono(fonction, repete, preparation=None):
+	durees = []
+	for k in range(repete):
+		argument = preparation() if preparation else None
+		debut = perf_counter()
+		fonction(argument) if preparation else fonction()
+		durees.append((perf_counter() - debut) * 1000)
+	return resume(durees)
+
+# une mission synthétique : clef primaire, utilisateur, agence, date, lieu, heures de début et de fin
+def mission(aleatoire, utilisateur, numero):
+	debut = aleatoire.randint(6, 14)
+	return [
+		f"{utilisateur:08x}{numero:024x}",
+		f"utilisateur{utilisateur}",
+		aleatoire.choice(["appel medical", "adecco"]),
+		f"{aleatoire.randint(2020, 2025)}-{aleatoire.randint(1, 12):02d}-{aleatoire.randint(1, 28):02d}",
+		aleatoire.choice(["lyon", "villeurbanne", "bron", "vénissieux", "caluire"]),
+		f"{debut:02d}:{aleatoire.choice(['00', '15', '30', '45'])}",
+		f"{debut + aleatoire.randint(2, 9):02d}:{aleatoire.choice(['00', '15', '30', '45'])}",
+	]
+
+# crée une base de donnée synthétique de 'utilisateurs' utilisateurs ayant chacun 'missions' missions
+def genere_bdd(chemin, utilisateurs, missions):
+	aleatoire = Random(GRAINE)
+	with interimBot.obj_bdd(chemin, interimBot.BDD_TABLE, pragmas=interimBot.PRAGMAS_BDD) as bdd:
+		lot = []
+		for utilisateur in range(utilisateurs):
+			for numero in range(missions):
+				lot.append(mission(aleatoire, utilisateur, numero))
+				if len(lot) == LOT:
+					bdd.createMany(lot)
+					lot = []
+		bdd.createMany(lot)
+		bdd.save()
+		bdd.maintenance()
+
+# mesure des opérations sur une base de donnée synthétique, pour le premier utilisateur
+def mesure_bdd(dossier, utilisateurs, missions, repete):
+	chemin = os.path.join(dossier, f"bench_{utilisateurs}_{missions}.db")
+	debut = perf_counter()
+	genere_bdd(chemin, utilisateurs, missions)
+	generation = (perf_counter() - debut) * 1000
+	username = "utilisateur0"
+	operations = {}
+	aleatoire = Random(GRAINE)
+	with interimBot.obj_bdd(chemin, interimBot.BDD_TABLE, pragmas=interimBot.PRAGMAS_BDD) as bdd:
+		# lectures sans cache
+		operations["getDatas"] = chrono(lambda: bdd.getDatas(username, "all"), repete)
+		operations["getPage"] = chrono(lambda: bdd.getPage(username, interimBot.AFFICHAGE_PAGE), repete)
+		operations["compte"] = chrono(lambda: bdd.compte(username), repete)
+		# mise en forme des missions
+		datas = bdd.getDatas(username, "all")
+		operations["bdd_to_string"] = chrono(lambda: [interimBot.bdd_to_string(k) for k in datas], repete)
+		operations["bdd_to_strings"] = chrono(lambda: interimBot.bdd_to_strings(datas), repete)
+		# création du fichier excel
+		operations["ecrit_excel"] = chrono(lambda: interimBot.ecrit_excel(bdd, username), repete)
+		# ajouts et suppressions d'une mission, chacun dans sa propre transaction
+		nouvelles = [mission(aleatoire, utilisateurs, k) for k in range(repete)]
+		a_creer, a_supprimer = iter(nouvelles), iter(k[0] for k in nouvelles)
+		operations["create"] = chrono(lambda valeurs: (bdd.create(valeurs), bdd.save()), repete, lambda: next(a_creer))
+		operations["delete"] = chrono(lambda clef: (bdd.delete(clef, f"utilisateur{utilisateurs}"), bdd.save()), repete, lambda: next(a_supprimer))
+	# lecture en cache : la première lecture remplit le cache du pool
+	pool = interimBot.pool_bdd(chemin, interimBot.BDD_TABLE, interimBot.PRAGMAS_BDD)
+	def lecture_cache():
+		with pool.borrow() as bdd:
+			bdd.getDatas(username, "all")
+	lecture_cache()
+	operations["getDatas_cache"] = chrono(lecture_cache, repete)
+	pool.close()
+	# nettoyage après export de toutes les missions de l'utilisateur, sur une copie de la base de donnée à chaque répétition
+	copies = []
+	def copie():
+		cible = os.path.join(dossier, f"copie_{len(copies)}.db")
+		shutil.copy(chemin, cible)
+		bdd = interimBot.obj_bdd(cible, interimBot.BDD_TABLE, pragmas=interimBot.PRAGMAS_BDD)
+		copies.append((cible, bdd))
+		return bdd, [k[0] for k in bdd.getDatas(username, "all")]
+	operations["purge"] = chrono(lambda copie: (copie[0].purge(username, copie[1]), copie[0].save()), repete, copie)
+	for cible, bdd in copies:
+		bdd.close()
+		os.remove(cible)
+	os.remove(chemin)
+	return {
+		"utilisateurs": utilisateurs,
+		"missions_par_utilisateur": missions,
+		"lignes": utilisateurs * missions,
+		"generation_ms": round(generation, 3),
+		"operations_ms": operations,
+	}
+
+# les médianes de toutes les mesures, pour la comparaison avec une référence
+def medianes(resultat):
+	valeurs = {}
+	for clef in ("demarrage_ms", "import_interimBot_ms"):
+		if clef in resultat:
+			valeurs[clef] = resultat[clef]["mediane"]
+	for taille in resultat.get("tailles", []):
+		for operation, mesure in taille["operations_ms"].items():
+			valeurs[f"{taille['utilisateurs']}x{taille['missions_par_utilisateur']} {operation}"] = mesure["mediane"]
+	return valeurs
+
+# compare les mesures à celles de référence, renvois les mesures plus lentes que la tolérance
+def compare(resultat, reference, tolerance):
+	problemes = []
+	anciennes = medianes(reference)
+	for clef, actuel in medianes(resultat).items():
+		ancien = anciennes.get(clef)
+		if ancien and actuel > ancien * (1 + tolerance) and actuel - ancien > ECART_MINIMUM:
+			problemes.append(f"{clef} : {actuel:.1f} ms contre {ancien:.1f} ms en référence (+{(actuel / ancien - 1) * 100:.0f} %)")
+	return problemes
+
+
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~	FONCTION PRINCIPALE	~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+# fonction principale
+if __name__ == "__main__":
+	parser = ArgumentParser(description="mesure les performances du bot")
+	parser.add_argument("mesure", choices=["demarrage", "bdd"], help="la mesure à faire")
+	parser.add_argument("--repete", type=int, default=5, help="nombre de répétitions de la mesure")
+	parser.add_argument("--utilisateurs", type=int, default=10, help="nombre d'utilisateurs des bases de donnée synthétiques")
+	parser.add_argument("--missions", type=int, nargs="+", default=[10, 1000, 10000], help="nombres de missions par utilisateur")
+	parser.add_argument("--dossier", help="dossier des bases de donnée synthétiques (temporaire par défaut)")
+	parser.add_argument("--reference", help="fichier json de mesures de référence")
+	parser.add_argument("--tolerance", type=float, default=0.2, help="ralentissement toléré par rapport à la référence")
+	parser.add_argument("--sortie", help="fichier json où écrire les mesures")
+	args = parser.parse_args()
+
+	if args.mesure == "demarrage":
+		mesures, problemes = mesure_demarrage(args.repete)
+	else:
+		# le bot est importé depuis son dossier, les bases de donnée sont créées dans un dossier temporaire
+		sys.path.insert(0, BASEPATH)
+		import interimBot
+		with tempfile.TemporaryDirectory(dir=args.dossier) as dossier:
+			mesures = {"tailles": [mesure_bdd(dossier, args.utilisateurs, k, args.repete) for k in args.missions]}
+		problemes = []
+	resultat = {
+		"mesure": args.mesure,
+		"version": version_git(),
+		"python": platform.python_version(),
+		"machine": platform.machine(),
+		"repetitions": args.repete,
+		**mesures,
+	}
+
+	# comparaison avec la référence
+	if args.reference:
+		with open(args.reference, "r") as f:
+			problemes += compare(resultat, json.load(f), args.tolerance)
+	resultat["problemes"] = problemes
+
+	texte = json.dumps(resultat, indent=2, ensure_ascii=False)
+	if args.sortie:
+		with open(args.sortie, "w") as f:
+			f.write(texte)
+	print(texte)
+	if problemes:
+		sys.exit(1)
+
+
+# fin
@@ -132,7 +132,12 @@ if __name__ == "__main__":
         if "retard" in output or "behind" in output or "git pull" in output:
             # copie la base de donnée sur l'hôte
             if KEEP_DB:
-                _, out, err = ssh_client.exec_command(f"docker cp interim_bot_1:/{basepath_server}/{DB_FILENAME} /tmp/temp_interim.db")
+                # recopie le journal WAL dans la base de donnée copiée juste après (erreur si elle n'existe pas à ce chemin)
+                chemin_bdd = f"/{basepath_server}/{DB_FILENAME}"
+                _, stdout, stderr = ssh_client.exec_command(f"docker exec interim_bot_1 python -c \"import sqlite3; sqlite3.connect('file:{chemin_bdd}?mode=rw', uri=True).execute('PRAGMA wal_checkpoint(TRUNCATE)')\"")
+                out, err = stdout.read(), stderr.read()
+                verify_no_errs(out, err)
+                _, out, err = ssh_client.exec_command(f"docker cp interim_bot_1:{chemin_bdd} /tmp/temp_interim.db")
                 out, err = stdout.read(), stderr.read()
                 verify_no_errs(out, err)
             # met à jour
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+##																				   ##
+##  ----  ----  ----	 TEST DU WEBHOOK DU BOT INTERIMBOT	  ----  ----  ----  ##
+##																				   ##
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+## programme pour envoyer au serveur webhook local du bot des mises à jour telegram enregistrées
+## au format json (une mise à jour ou une liste de mises à jour par fichier) et mesurer le temps de réponse.
+## sans fichier, une commande '/help' fictive est envoyée.
+##   python3 interimBot_webhook.py [--repete N] [fichier.json ...]
+
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~		PARAMETRES		 ~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+# modules complémentaires
+import os
+import sys
+import json
+from argparse import ArgumentParser
+from re import compile as reCompile
+from time import perf_counter, time
+from urllib.request import Request, urlopen
+
+# la configuration du webhook est lue dans le .env du bot
+BASEPATH = os.path.realpath(os.path.dirname(sys.argv[0]))
+REGEX_WEBHOOK = reCompile("webhook_(url|listen|port|path|secret)=([a-zA-Z0-9.:/_-]+)")
+WEBHOOK = {
+	"listen": "127.0.0.1",
+	"port": "8080",
+	"path": "interimbot",
+	"secret": "",
+}
+
+# mise à jour envoyée par défaut
+UPDATE_DEFAUT = {
+	"update_id": 1,
+	"message": {
+		"message_id": 1,
+		"date": 0,
+		"chat": {"id": 1, "type": "private", "username": "test"},
+		"from": {"id": 1, "is_bot": False, "first_name": "test", "username": "test"},
+		"text": "/help",
+		"entities": [{"type": "bot_command", "offset": 0, "length": 5}],
+	},
+}
+
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~		 FONCTIONS		 ~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+# renvois l'adresse locale du webhook configurée dans le .env
+def url_webhook():
+	webhook = dict(WEBHOOK)
+	if os.path.isfile(os.path.join(BASEPATH, ".env")):
+		with open(os.path.join(BASEPATH, ".env"), "r") as f:
+			webhook.update(REGEX_WEBHOOK.findall(f.read()))
+	# le serveur écoute sur toutes les interfaces, on passe par la boucle locale
+	hote = "127.0.0.1" if webhook["listen"] in ("0.0.0.0", "::") else webhook["listen"]
+	url_path = "/".join(k for k in (webhook["path"], webhook["secret"]) if k)
+	return f"http://{hote}:{webhook['port']}/{url_path}"
+
+# charge les mises à jour enregistrées dans un fichier json
+def charge_updates(fichier):
+	with open(fichier, "r") as f:
+		datas = json.load(f)
+	if isinstance(datas, dict):
+		return [datas]
+	return datas
+
+# envoit une mise à jour au webhook et renvois le code http et la durée en millisecondes
+def envoie(url, update):
+	requete = Request(url, data=json.dumps(update).encode(), headers={"Content-Type": "application/json"}, method="POST")
+	debut = perf_counter()
+	with urlopen(requete, timeout=10) as reponse:
+		code = reponse.status
+	return code, (perf_counter() - debut) * 1000
+
+
+## ~~~~~~~~~~~~~~~~~~~~~~~~~~	FONCTION PRINCIPALE	~~~~~~~~~~~~~~~~~~~~~~~~~~ ##
+
+# fonction principale
+if __name__ == "__main__":
+	parser = ArgumentParser(description="envoit des mises à jour enregistrées au webhook local du bot")
+	parser.add_argument("fichiers", nargs="*", help="fichiers json de mises à jour")
+	parser.add_argument("--repete", type=int, default=1, help="nombre d'envois de chaque mise à jour")
+	args = parser.parse_args()
+
+	url = url_webhook()
+	print(f"webhook : {url}")
+	updates = []
+	for fichier in args.fichiers:
+		updates += charge_updates(fichier)
+	if not updates:
+		updates = [UPDATE_DEFAUT]
+
+	durees = []
+	update_id = int(time())
+	for k in range(args.repete):
+		for update in updates:
+			# chaque envoi a un identifiant unique pour ne pas etre ignoré
+			update = dict(update, update_id=update_id)
+			update_id += 1
+			try:
+				code, duree = envoie(url, update)
+			except Exception as e:
+				print(f"[!] {e}")
+				sys.exit(1)
+			durees.append(duree)
+			print(f"{code} en {duree:.1f} ms")
+
+	durees.sort()
+	print(f"{len(durees)} mises à jour, médiane {durees[len(durees)//2]:.1f} ms, max {durees[-1]:.1f} ms")
+
+
+# fin